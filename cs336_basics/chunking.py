@@ -0,0 +1,100 @@
+import mmap
+import os
+
+SEARCH_WINDOW = 1 << 16  # bytes searched first around a boundary, doubled until a split point is found
+
+def find_chunk_boundaries(
+    path,
+    num_chunks: int,
+    split_tokens: list[bytes],
+    split_after: bool = False,
+) -> list[int]:
+    """
+    Split the file at `path` into `num_chunks` parts of about the same size that can be processed independently,
+    returns the sorted byte offsets `[0, ..., file_size]` (chunk i is `[boundaries[i], boundaries[i + 1])`).
+
+    Every inner boundary is at the start of one of the `split_tokens` (at its end with `split_after`), never inside
+    an occurrence of another split token. Fewer chunks are returned only when the file doesn't have enough places
+    to split at.
+
+    The file is scanned through mmap with `find` / `rfind`, only around the boundaries. The boundaries are placed
+    one after the other, each at the split point closest to an even split of what is left of the file, so a long
+    document only makes its own chunk bigger instead of merging the following chunks into one.
+
+    Usage:
+        boundaries = find_chunk_boundaries(path, 4 * num_workers, [b"<|endoftext|>"])
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            ...
+    """
+    split_tokens = [t for t in split_tokens if t]
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return [0]
+    if not split_tokens or num_chunks <= 1:
+        return [0, file_size]
+
+    boundaries = [0]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while len(boundaries) < num_chunks:
+            previous = boundaries[-1]
+            target = previous + (file_size - previous) // (num_chunks - len(boundaries) + 1)
+            before = _last_split_point(mm, previous + 1, target, split_tokens, split_after)
+            after = _first_split_point(mm, max(target, previous + 1), split_tokens, split_after)
+            candidates = [b for b in (before, after) if previous < b < file_size]
+            if not candidates:
+                break
+            boundaries.append(min(candidates, key=lambda b: abs(b - target)))
+    boundaries.append(file_size)
+
+    return boundaries
+
+def _inside_token(mm, position, split_tokens):
+    # whether an occurrence of a split token spans `position` (starts before it and ends after it)
+    return any(mm.find(t, max(0, position - len(t) + 1), position + len(t) - 1) != -1 for t in split_tokens)
+
+def _first_split_point(mm, start, split_tokens, split_after):
+    # smallest split point >= start, -1 if there is none.
+    # Searched in growing windows, so a rare split token doesn't make every search run to the end of the file
+    window = SEARCH_WINDOW
+    while start <= len(mm):
+        best = _split_points_in(mm, start, start + window, split_tokens, split_after, last=False)
+        if best != -1:
+            return best
+        start += window
+        window *= 2
+    return -1
+
+def _last_split_point(mm, start, end, split_tokens, split_after):
+    # largest split point in [start, end), -1 if there is none (searched in growing windows, like above)
+    window = SEARCH_WINDOW
+    while end > start:
+        best = _split_points_in(mm, max(start, end - window), end, split_tokens, split_after, last=True)
+        if best != -1:
+            return best
+        end -= window
+        window *= 2
+    return -1
+
+def _split_points_in(mm, start, end, split_tokens, split_after, last):
+    # first (or `last`) split point in [start, end), -1 if there is none
+    best = -1
+    for token in split_tokens:
+        shift = len(token) if split_after else 0  # split point - token start
+        # token starts in [start - shift, end - shift), the search for the next tokens stops at the best point so far
+        token_start, token_end = max(0, start - shift), max(0, end - shift)
+        if best != -1:
+            if last:
+                token_start = max(token_start, best - shift + 1)
+            else:
+                token_end = min(token_end, best - shift)
+        find = mm.rfind if last else mm.find
+        pos = find(token, token_start, token_end + len(token) - 1)
+        while pos != -1:
+            if not _inside_token(mm, pos + shift, split_tokens):
+                best = pos + shift
+                break
+            if last:
+                pos = mm.rfind(token, token_start, pos + len(token) - 1)
+            else:
+                pos = mm.find(token, pos + 1, token_end + len(token) - 1)
+    return best
@@ -0,0 +1,370 @@
+import hashlib
+from itertools import islice
+import json
+import mmap
+from multiprocessing import Pool
+import os
+import pickle
+import shutil
+
+import numpy as np
+import torch
+
+from cs336_basics.chunking import find_chunk_boundaries
+from cs336_basics.progress import Phase
+from cs336_basics.tokenizer import Tokenizer
+from cs336_basics.train_bpe import read_in_chunks
+
+MANIFEST_NAME = "manifest.json"
+
+def tokenize_to_shards(
+    input_path: str,
+    output_dir: str,
+    tokenizer: Tokenizer,
+    num_workers: int | None = None,
+    shard_bytes: int = 64 * 1024 * 1024,
+    split_special_token: str = "<|endoftext|>",
+    dtype=np.uint16,
+    block_size: int = 1 << 20,
+    progress=None,
+) -> dict:
+    """
+    Tokenize the text file at `input_path` into shards of token ids in `output_dir`, described by a manifest
+    (`output_dir/manifest.json`), returns the manifest.
+
+    The file is split after `split_special_token`s into shards of about `shard_bytes` of text, the shards are
+    tokenized in a process pool and streamed `block_size` ids at a time to `shard_XXXXX.bin` (`np.memmap(path, dtype)`).
+    Next to every shard, `shard_XXXXX.docs` holds the start of each document in it (int64 positions, documents end
+    with `split_special_token`, see `load_doc_offsets`).
+    The manifest records for every shard its source byte range, number of tokens and documents and sha256,
+    and is saved again every time a shard is done. Running again with the same arguments only tokenizes the shards
+    that are not done (missing, or with another size or sha256 than in the manifest), so an interrupted job picks
+    up where it stopped. The done shards are read once to check their sha256. A source file that was modified since
+    (other size or mtime) is not resumed.
+
+    Usage:
+        tokenizer = Tokenizer.from_file("data/out/owt_32000.tok")
+        tokenize_to_shards("data/raw/owt_train.txt", "data/owt/train", tokenizer, num_workers=8)
+        dataset = load_token_dataset("data/owt/train/manifest.json")
+    """
+    dtype = np.dtype(dtype)
+    if max(tokenizer.vocav) > np.iinfo(dtype).max:
+        raise ValueError(f"a vocab of {len(tokenizer.vocav)} tokens does not fit in {dtype}")
+    split_token_bytes = split_special_token.encode("utf-8")
+    if split_token_bytes not in tokenizer.special_token_bytes:
+        raise ValueError(f"{split_special_token} is not a special token of the tokenizer")
+    eot_id = tokenizer.inv_vocab[split_token_bytes]
+    num_workers = num_workers or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+    # everything the shards depend on, a manifest written with other settings can't be resumed
+    source_stat = os.stat(input_path)
+    settings = {
+        "version": 3,
+        "source": os.path.abspath(input_path),
+        "source_bytes": source_stat.st_size,
+        "source_mtime_ns": source_stat.st_mtime_ns,
+        "tokenizer_sha256": tokenizer_hash(tokenizer),
+        "dtype": dtype.name,
+        "split_special_token": split_special_token,
+        "shard_bytes": shard_bytes,
+    }
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        changed = [key for key, value in settings.items() if manifest.get(key) != value]
+        if changed:
+            raise ValueError(f"{manifest_path} was written with different {', '.join(changed)}, "
+                             f"remove {output_dir} to start over")
+    else:
+        # shards start right after a split token, i.e. with a new document
+        boundaries = find_chunk_boundaries(input_path, max(1, -(-settings["source_bytes"] // shard_bytes)),
+                                           [split_token_bytes], split_after=True)
+        shards = [{"path": f"shard_{i:05d}.bin", "docs": f"shard_{i:05d}.docs", "start": start, "end": end,
+                   "num_tokens": None, "num_docs": None, "sha256": None}
+                  for i, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+        manifest = {**settings, "num_tokens": None, "shards": shards}
+        save_manifest(manifest_path, manifest)
+
+    # a shard is done once it is in the manifest with the size and the sha256 it was written with
+    shards = manifest["shards"]
+    pending = [i for i, shard in enumerate(shards)
+               if shard["num_tokens"] is None
+               or not _has_size(os.path.join(output_dir, shard["path"]), shard["num_tokens"] * dtype.itemsize)
+               or not _has_size(os.path.join(output_dir, shard["docs"]), shard["num_docs"] * 8)
+               or _file_sha256(os.path.join(output_dir, shard["path"])) != shard["sha256"]]
+    jobs = [(i, input_path, shards[i]["start"], shards[i]["end"], os.path.join(output_dir, shards[i]["path"]),
+             os.path.join(output_dir, shards[i]["docs"]), dtype, eot_id, block_size) for i in pending]
+
+    with Phase(progress, "tokenization", total=len(shards), input_bytes=settings["source_bytes"]) as phase:
+        phase.metrics["num_skipped"] = len(shards) - len(jobs)
+        if num_workers > 1 and len(jobs) > 1:
+            pool = Pool(min(num_workers, len(jobs)), initializer=_init_worker, initargs=(tokenizer,))
+            results = pool.imap_unordered(_tokenize_shard, jobs)
+        else:
+            pool = None
+            _init_worker(tokenizer)
+            results = map(_tokenize_shard, jobs)
+        try:
+            for done, (i, num_tokens, num_docs, checksum) in enumerate(results, len(shards) - len(jobs) + 1):
+                shards[i]["num_tokens"] = num_tokens
+                shards[i]["num_docs"] = num_docs
+                shards[i]["sha256"] = checksum
+                save_manifest(manifest_path, manifest)
+                phase.report(done)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        manifest["num_tokens"] = sum(shard["num_tokens"] for shard in shards)
+        manifest["num_docs"] = sum(shard["num_docs"] for shard in shards)
+        save_manifest(manifest_path, manifest)
+        phase.metrics["num_tokens"] = manifest["num_tokens"]
+        phase.metrics["num_docs"] = manifest["num_docs"]
+
+    return manifest
+
+def tokenize_to_bin(input_path: str, output_path: str, tokenizer: Tokenizer, progress=None, **kwargs) -> int:
+    """
+    Tokenize the text file at `input_path` into one flat file of token ids (`np.memmap(output_path, dtype)`),
+    returns the number of tokens.
+
+    Runs `tokenize_to_shards` (same keyword arguments) into `{output_path}.shards`, so it is resumable as well,
+    then appends the shards in order to `output_path` and removes them, never holding more than a shard in memory.
+    The document offsets of the shards are merged the same way into `doc_offsets_path(output_path)`.
+    """
+    shards_dir = f"{output_path}.shards"
+    manifest = tokenize_to_shards(input_path, shards_dir, tokenizer, progress=progress, **kwargs)
+
+    with Phase(progress, "concatenation", num_shards=len(manifest["shards"])):
+        tmp_path, docs_tmp_path = f"{output_path}.tmp", f"{doc_offsets_path(output_path)}.tmp"
+        with open(tmp_path, "wb") as out, open(docs_tmp_path, "wb") as docs_out:
+            offset = 0
+            for shard in manifest["shards"]:
+                with open(os.path.join(shards_dir, shard["path"]), "rb") as f:
+                    shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+                # shard positions -> positions in the whole file
+                (np.fromfile(os.path.join(shards_dir, shard["docs"]), dtype=np.int64) + offset).tofile(docs_out)
+                offset += shard["num_tokens"]
+        os.replace(tmp_path, output_path)
+        os.replace(docs_tmp_path, doc_offsets_path(output_path))
+    shutil.rmtree(shards_dir)
+
+    return manifest["num_tokens"]
+
+def doc_offsets_path(path: str) -> str:
+    # the document offsets of a flat `.bin` file of tokens, e.g. train.bin -> train.docs
+    return os.path.splitext(path)[0] + ".docs"
+
+def tokenizer_hash(tokenizer: Tokenizer) -> str:
+    # sha256 identifying the vocab, merges and special tokens
+    state = (sorted(tokenizer.vocav.items()), tokenizer.merges, tokenizer.special_tokens)
+    return hashlib.sha256(pickle.dumps(state, protocol=4)).hexdigest()
+
+def save_manifest(path, manifest):
+    # written to a temporary file first, a job killed while saving keeps the previous manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+def load_token_dataset(path: str, dtype=np.uint16) -> list[np.ndarray]:
+    """
+    Memory map a tokenized dataset: a `manifest.json` written by `tokenize_to_shards` (one array per shard,
+    in order, the dtype comes from the manifest) or a flat `.bin` file of `dtype` ids (a single array).
+    """
+    if os.path.basename(path) != MANIFEST_NAME:
+        return [np.memmap(path, dtype=dtype, mode="r")]
+
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest["num_tokens"] is None:
+        raise ValueError(f"{path} describes a tokenization that did not finish")
+    output_dir = os.path.dirname(path)
+    return [np.memmap(os.path.join(output_dir, shard["path"]), dtype=manifest["dtype"], mode="r")
+            for shard in manifest["shards"] if shard["num_tokens"]]
+
+def load_doc_offsets(path: str) -> list[np.ndarray]:
+    """
+    Memory map the document offsets of a tokenized dataset, matching `load_token_dataset(path)`: one int64 array
+    per token array, holding the position where each of its documents starts (the first one at 0).
+    Document `i` of a token array is `tokens[offsets[i]:offsets[i + 1]]`, the last one ends with the array.
+    """
+    if os.path.basename(path) != MANIFEST_NAME:
+        return [np.memmap(doc_offsets_path(path), dtype=np.int64, mode="r")]
+
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest["num_tokens"] is None:
+        raise ValueError(f"{path} describes a tokenization that did not finish")
+    output_dir = os.path.dirname(path)
+    return [np.memmap(os.path.join(output_dir, shard["docs"]), dtype=np.int64, mode="r")
+            for shard in manifest["shards"] if shard["num_tokens"]]
+
+class BatchSampler:
+    """
+    Samples batches of language modeling windows from a tokenized dataset, without copying the dataset:
+
+        sampler = BatchSampler(load_token_dataset("data/owt/train/manifest.json"), 64, 256, "cuda")
+        x, y = sampler.sample()
+
+    `dataset` is an array of token ids (e.g. `np.memmap` of a `.bin`) or a list of arrays, e.g. the shards from
+    `load_token_dataset` (a window never crosses two of them). Windows are drawn uniformly from all the windows.
+
+    The windows are gathered from the memmaps with one fancy index per array into a preallocated buffer of the
+    dataset's dtype, then converted to int64 once, straight into a preallocated (pinned, for cuda) buffer,
+    and copied to `device` into a preallocated tensor. `sample` returns views of that tensor, so a batch is
+    overwritten by the next one - `clone()` it to keep it.
+
+    With `random_access` the memmaps are advised for random access (no read-ahead), by default when they are
+    bigger than half the memory.
+    """
+    def __init__(self, dataset, batch_size: int, context_length: int, device: str = "cpu", seed: int | None = None,
+                 random_access: bool | None = None):
+        self.shards = [dataset] if isinstance(dataset, np.ndarray) else list(dataset)
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.device = torch.device(device)
+        self.rng = np.random.default_rng(seed)
+
+        # windows are read at random places: once the data doesn't fit in memory, reading ahead of them only wastes IO.
+        # Data that does fit is left alone, the kernel maps the cached pages around a fault faster that way
+        mapped = [shard for shard in self.shards if isinstance(shard, np.memmap) and shard._mmap is not None]
+        if random_access is None:
+            memory = _physical_memory()
+            random_access = memory is not None and sum(shard.nbytes for shard in mapped) > memory // 2
+        if random_access and hasattr(mmap, "MADV_RANDOM"):
+            for shard in mapped:
+                shard._mmap.madvise(mmap.MADV_RANDOM)
+
+        self.num_starts = np.array([max(0, len(shard) - context_length) for shard in self.shards], dtype=np.int64)
+        self.cumulative_starts = np.cumsum(self.num_starts)
+        if len(self.shards) == 0 or self.cumulative_starts[-1] == 0:
+            raise ValueError(f"the dataset has no window of {context_length + 1} tokens")
+
+        # token positions of the windows, and the windows in the dataset's dtype
+        self.offsets = np.arange(context_length + 1)
+        self.positions = np.empty((batch_size, context_length + 1), dtype=np.int64)
+        self.windows = np.empty((batch_size, context_length + 1), dtype=np.result_type(*self.shards))
+        # the inputs and the labels, both contiguous: (2, batch_size, context_length) int64
+        self.host = torch.empty((2, batch_size, context_length), dtype=torch.int64,
+                                pin_memory=self.device.type == "cuda")
+        self.out = self.host if self.device.type == "cpu" else torch.empty_like(self.host, device=self.device)
+        # end of the last asynchronous copy to a cuda device, the host buffer can't be written before it
+        self.copy_done = None
+        # the inputs and the labels as one strided view of the windows, for the single conversion to int64
+        step = self.windows.itemsize
+        self.shifted_windows = np.lib.stride_tricks.as_strided(
+            self.windows, shape=(2, batch_size, context_length), strides=(step, self.windows.strides[0], step),
+            writeable=False)
+
+    def sample(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the inputs and the labels (the inputs shifted by one), int64 `(batch_size, context_length)` tensors.
+        """
+        starts = self.rng.integers(0, self.cumulative_starts[-1], size=self.batch_size)
+        if len(self.shards) == 1:
+            np.add(starts[:, None], self.offsets, out=self.positions)
+            # no bounds checks and no temporary: the positions are valid by construction
+            np.take(self.shards[0], self.positions, out=self.windows, mode="clip")
+        else:
+            shard_ids = np.searchsorted(self.cumulative_starts, starts, side="right")
+            starts -= self.cumulative_starts[shard_ids] - self.num_starts[shard_ids]
+            np.add(starts[:, None], self.offsets, out=self.positions)
+            for shard_id in np.unique(shard_ids):
+                rows = shard_ids == shard_id
+                self.windows[rows] = self.shards[shard_id][self.positions[rows]]
+
+        if self.copy_done is not None:
+            self.copy_done.synchronize()
+        np.copyto(self.host.numpy(), self.shifted_windows)
+        if self.device.type == "cuda":
+            self.out.copy_(self.host, non_blocking=True)
+            self.copy_done = torch.cuda.Event()
+            self.copy_done.record()
+        elif self.out is not self.host:
+            self.out.copy_(self.host)
+        return self.out[0], self.out[1]
+
+def get_batch(dataset, batch_size: int, context_length: int, device: str) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Sample one batch of `batch_size` windows of `context_length + 1` tokens from `dataset` (an array of token ids
+    or a list of arrays, as for `BatchSampler`), returns the inputs and the labels (the inputs shifted by one),
+    as int64 tensors on `device`.
+
+    The tensors belong to the caller. To sample many batches, keep a `BatchSampler` instead - it reuses its buffers
+    and copies to the device asynchronously, but each batch is overwritten by the next one.
+    """
+    shards = [dataset] if isinstance(dataset, np.ndarray) else list(dataset)
+    offsets = np.arange(context_length + 1)
+    if len(shards) == 1:
+        num_starts = len(shards[0]) - context_length
+        if num_starts <= 0:
+            raise ValueError(f"the dataset has no window of {context_length + 1} tokens")
+        starts = np.random.randint(0, num_starts, size=batch_size)
+        windows = shards[0][starts[:, None] + offsets]
+    else:
+        num_starts = np.array([max(0, len(shard) - context_length) for shard in shards], dtype=np.int64)
+        cumulative_starts = np.cumsum(num_starts)
+        if len(shards) == 0 or cumulative_starts[-1] == 0:
+            raise ValueError(f"the dataset has no window of {context_length + 1} tokens")
+        starts = np.random.randint(0, cumulative_starts[-1], size=batch_size)
+        shard_ids = np.searchsorted(cumulative_starts, starts, side="right")
+        starts -= cumulative_starts[shard_ids] - num_starts[shard_ids]
+        windows = np.empty((batch_size, context_length + 1), dtype=np.result_type(*shards))
+        for shard_id in np.unique(shard_ids):
+            rows = shard_ids == shard_id
+            windows[rows] = shards[shard_id][starts[rows, None] + offsets]
+
+    windows = torch.from_numpy(windows.astype(np.int64)).to(device)
+    return windows[:, :-1], windows[:, 1:]
+
+def _physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def _has_size(path, size):
+    return os.path.exists(path) and os.path.getsize(path) == size
+
+def _file_sha256(path, chunk_size=1 << 20):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+_worker_tokenizer = None
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _tokenize_shard(args):
+    # tokenize the byte range [start, end) of the input into `path` and the document starts into `docs_path`,
+    # returns `index, num_tokens, num_docs, sha256`
+    index, input_path, start, end, path, docs_path, dtype, eot_id, block_size = args
+    ids = _worker_tokenizer.encode_iterable(read_in_chunks(input_path, chunk_size=1024 * 1024, start=start, end=end))
+    num_tokens = 0
+    doc_starts = [np.zeros(1, dtype=np.int64)]
+    checksum = hashlib.sha256()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        while True:
+            block = np.fromiter(islice(ids, block_size), dtype=dtype)
+            if len(block) == 0:
+                break
+            block.tofile(f)
+            checksum.update(block.tobytes())
+            # a new document starts after every end of text token
+            doc_starts.append(np.flatnonzero(block == eot_id).astype(np.int64) + num_tokens + 1)
+            num_tokens += len(block)
+
+    doc_starts = np.concatenate(doc_starts)
+    doc_starts = doc_starts[doc_starts < num_tokens]
+    doc_starts.tofile(f"{docs_path}.tmp")
+    os.replace(f"{docs_path}.tmp", docs_path)
+    os.replace(tmp_path, path)
+    return index, num_tokens, len(doc_starts), checksum.hexdigest()
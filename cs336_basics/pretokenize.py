@@ -0,0 +1,127 @@
+from collections.abc import Iterable, Iterator
+import regex as re
+
+PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+_pat = re.compile(PAT)
+
+class SpecialTokenMatcher:
+    """
+    Finds special tokens in a text with a trie of the tokens, built once.
+
+    The trie is compiled into a single regex (a token that is a prefix of another becomes an optional tail), so the
+    text is scanned once by the C regex engine whatever the number of tokens, and the longest token wins when they
+    overlap. A pure python Aho-Corasick scan was measured slower than this on both long and short texts.
+    """
+    def __init__(self, special_tokens: list[str]):
+        self.tokens = {t for t in special_tokens if t}
+        self.max_len = max((len(t) for t in self.tokens), default=0)
+        self.trie = {}
+        for token in self.tokens:
+            node = self.trie
+            for c in token:
+                node = node.setdefault(c, {})
+            node[""] = {}  # end of a token
+        self.first_chars = {c for c in self.trie if c}
+        self.pat = re.compile("(" + self._node_pattern(self.trie) + ")") if self.tokens else None
+
+    @classmethod
+    def _node_pattern(cls, node):
+        alternatives = [re.escape(c) + cls._node_pattern(child) for c, child in sorted(node.items()) if c]
+        if not alternatives:
+            return ""
+        pattern = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        if "" in node:
+            # a token ends here, the longer tokens continuing it are optional
+            return ("(?:" + pattern + ")" if len(alternatives) == 1 else pattern) + "?"
+        return pattern
+
+    def split(self, text: str) -> list[str]:
+        """
+        Splits `text` around the special tokens: the parts at odd indices are the special tokens.
+        """
+        # fast path - no special token can start in the text
+        if self.pat is None or not any(c in text for c in self.first_chars):
+            return [text]
+        return self.pat.split(text)
+
+    def partial_suffix_len(self, text: str) -> int:
+        """
+        Length of the longest suffix of `text` that is the start of a special token (it may still grow into one).
+        """
+        for start in range(max(0, len(text) - self.max_len), len(text)):
+            node = self.trie
+            for c in text[start:]:
+                node = node.get(c)
+                if node is None:
+                    break
+            else:
+                return len(text) - start
+        return 0
+
+def iter_pre_tokens(text: str, matcher: SpecialTokenMatcher, keep_special: bool = True,
+                    final: bool = True) -> Iterator[bytes]:
+    """
+    Yield the pre-tokens of `text` (as utf-8 bytes), special tokens are kept whole or, unless `keep_special`, dropped.
+
+    Unless `final`, the text may continue, so the pre-tokens it could still change are held back: the generator
+    returns the offset they start at (`len(text)` when everything was yielded), `end = yield from ...`.
+    """
+    parts = matcher.split(text)
+
+    offset = 0
+    for i, part in enumerate(parts[:-1]):
+        offset += len(part)
+        if i % 2:  # special token
+            if keep_special:
+                yield part.encode("utf-8")
+            continue
+        for pretoken in _pat.finditer(part):
+            yield pretoken.group(0).encode("utf-8")
+
+    # last part (never a special token) - hold back its last two pre-tokens: the last one may continue, and that
+    # can change where the one before it ends ("'" "r" becomes "'re")
+    previous = last = None
+    for pretoken in _pat.finditer(parts[-1]):
+        if previous is not None:
+            yield previous.group(0).encode("utf-8")
+        previous, last = last, pretoken
+    if final:
+        for pretoken in (previous, last):
+            if pretoken is not None:
+                yield pretoken.group(0).encode("utf-8")
+        return len(text)
+    if previous is not None:
+        return offset + previous.start()
+    if last is not None:
+        return offset + last.start()
+    return len(text)
+
+def stream_pre_tokens(chunks: Iterable[str], matcher: SpecialTokenMatcher, keep_special: bool = True,
+                      buffer_size: int = 1) -> Iterator[bytes]:
+    """
+    `iter_pre_tokens` of a text given as an iterable of pieces, the pre-tokens are the same as over the whole text.
+
+    The pieces are scanned in buffers of at least `buffer_size` characters. Only the unfinished tail of a buffer
+    (its last two pre-tokens and a possibly partial special token) is carried to the next one, so memory is bounded
+    by the buffer size.
+    """
+    pending = []
+    pending_size = 0
+    threshold = buffer_size
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < threshold:
+            continue
+
+        buffer = "".join(pending)
+        cut = len(buffer) - matcher.partial_suffix_len(buffer)
+        end = yield from iter_pre_tokens(buffer[:cut], matcher, keep_special, final=False)
+
+        pending = [buffer[end:]]
+        pending_size = len(pending[0])
+        # a single pre-token longer than the buffer - wait for more text before scanning again
+        threshold = max(buffer_size, 2 * pending_size)
+
+    yield from iter_pre_tokens("".join(pending), matcher, keep_special)
@@ -0,0 +1,133 @@
+import json
+import resource
+import sys
+import time
+
+def peak_rss() -> int:
+    """
+    Peak resident memory (bytes) of this process, since the last `reset_peak_rss` on linux, over its lifetime elsewhere.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return 1024 * int(line.split()[1])
+    except OSError:
+        pass
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in KB on linux, bytes on macOS
+    return scale * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident memory of this process to its current one (linux only), returns whether it was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def workers_max_rss() -> int:
+    """
+    Largest peak resident memory (bytes) of the finished worker processes, over the lifetime of this process.
+    """
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+class Phase:
+    """
+    Context manager timing a phase of a long job and reporting it to a `progress` callback:
+
+        with Phase(progress, "merging") as phase:
+            ...
+            phase.metrics["num_merges"] = n
+
+    sends `{"event": "phase_start", "phase": ..., **info}` and then
+    `{"event": "phase_end", "phase": ..., "seconds": ..., "peak_rss": ..., **metrics}`.
+    `peak_rss` is the peak resident memory of this process during the phase. Where it can't be reset (not linux),
+    the record has the lifetime peak as `max_rss` instead. `workers_max_rss` is added once worker processes finished,
+    it is the largest peak of any of them so far, not only of this phase.
+    Long phases can report `{"event": "progress", "phase": ..., "done": ...}` records in between with `phase.report`.
+    Does nothing when `progress` is None - in particular, the peak memory of the process is only reset for a phase
+    that reports it.
+    """
+    def __init__(self, progress, name, **info):
+        self.progress = progress
+        self.name = name
+        self.info = info
+        self.metrics = {}
+
+    # the phases being timed, resetting the peak memory of a nested phase must not lose the peak of the outer one
+    _open = []
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.progress is not None:
+            if Phase._open:
+                Phase._open[-1].peak = max(Phase._open[-1].peak, peak_rss())
+            self.peak_reset = reset_peak_rss()
+            self.peak = 0
+            Phase._open.append(self)
+            self.progress({"event": "phase_start", "phase": self.name, **self.info})
+        return self
+
+    def report(self, done, **metrics):
+        if self.progress is not None:
+            self.progress({"event": "progress", "phase": self.name, "done": done, **metrics})
+
+    def __exit__(self, *exc):
+        if self.progress is not None:
+            Phase._open.remove(self)
+            self.peak = max(self.peak, peak_rss())
+            if Phase._open:
+                Phase._open[-1].peak = max(Phase._open[-1].peak, self.peak)
+            memory = {"peak_rss" if self.peak_reset else "max_rss": self.peak}
+            if workers_max_rss():
+                memory["workers_max_rss"] = workers_max_rss()
+            self.progress({
+                "event": "phase_end",
+                "phase": self.name,
+                "seconds": time.perf_counter() - self.start,
+                **memory,
+                **self.metrics,
+            })
+        return False
+
+class JsonLinesProgress:
+    """
+    Progress sink writing every record as a JSON line (to a path or an open text file, default stderr).
+    """
+    def __init__(self, file=None):
+        self.file = sys.stderr if file is None else file
+        if isinstance(self.file, str):
+            self.file = open(self.file, "a")
+
+    def __call__(self, record):
+        record = {"time": time.time(), **record}
+        self.file.write(json.dumps(record, default=repr) + "\n")
+        self.file.flush()
+
+class TqdmProgress:
+    """
+    Progress sink showing a tqdm bar for the merge phase, the other phases are written as one line each.
+    """
+    def __init__(self):
+        self.bar = None
+
+    def __call__(self, record):
+        from tqdm import tqdm
+
+        event = record["event"]
+        if event == "phase_start" and "total" in record:
+            self.bar = tqdm(total=record["total"], desc=record["phase"])
+        elif event == "progress" and self.bar is not None:
+            self.bar.update(record["done"] - self.bar.n)
+            self.bar.set_postfix({k: v for k, v in record.items() if k not in ("event", "phase", "done")})
+        elif event == "phase_end":
+            if self.bar is not None:
+                self.bar.close()
+                self.bar = None
+            metrics = ", ".join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}"
+                                for k, v in record.items() if k not in ("event", "phase"))
+            tqdm.write(f"{record['phase']} - {metrics}")
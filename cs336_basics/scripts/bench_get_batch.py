@@ -0,0 +1,42 @@
+# run from the repo root: python -m cs336_basics.scripts.bench_get_batch
+import os
+import time
+
+import numpy as np
+
+from cs336_basics.data import BatchSampler, get_batch
+
+# args
+data_path = 'data/bench/tokens_{size_gb}gb.bin'  # created (random uint16 ids) if missing
+sizes_gb = [1, 10]
+vocab_size = 32000
+batch_size = 64
+context_length = 256
+device = 'cpu'
+num_batches = 1000
+
+for size_gb in sizes_gb:
+    path = data_path.format(size_gb=size_gb)
+    num_tokens = size_gb * 2**30 // 2
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tokens = np.memmap(path, dtype=np.uint16, mode='w+', shape=(num_tokens,))
+        rng = np.random.default_rng(0)
+        for start in range(0, num_tokens, 1 << 26):
+            tokens[start:start + (1 << 26)] = rng.integers(0, vocab_size, size=min(1 << 26, num_tokens - start))
+        tokens.flush()
+        del tokens
+    dataset = np.memmap(path, dtype=np.uint16, mode='r')
+
+    sampler = BatchSampler(dataset, batch_size, context_length, device)
+    start_time = time.time()
+    for _ in range(num_batches):
+        x, y = sampler.sample()
+    elapsed = time.time() - start_time
+    print(f"{size_gb} GB | BatchSampler: {num_batches / elapsed:.0f} batches/s")
+
+    start_time = time.time()
+    for _ in range(num_batches):
+        x, y = get_batch(dataset, batch_size, context_length, device)
+    elapsed = time.time() - start_time
+    print(f"{size_gb} GB | get_batch: {num_batches / elapsed:.0f} batches/s")
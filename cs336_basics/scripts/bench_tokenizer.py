@@ -0,0 +1,77 @@
+# run from the repo root: python -m cs336_basics.scripts.bench_tokenizer
+import os
+import tempfile
+import time
+
+from cs336_basics.tokenizer import Tokenizer
+from cs336_basics.train_bpe import save_tokenizer_file
+from tests.test_tokenizer import MERGES_PATH, VOCAB_PATH, get_tokenizer_from_vocab_merges_path
+from tests.common import FIXTURES_PATH
+
+# args
+text_source = FIXTURES_PATH / 'tinystories_sample.txt'
+special_tokens = ['<|endoftext|>']
+repeats = 3
+
+tokenizer = get_tokenizer_from_vocab_merges_path(vocab_path=VOCAB_PATH, merges_path=MERGES_PATH,
+                                                 special_tokens=special_tokens)
+with open(text_source) as f:
+    text = f.read()
+
+# startup - constructing the tokenizer from the GPT-2 vocab and merges (already parsed)
+num_inits = 20
+start_time = time.time()
+for _ in range(num_inits):
+    Tokenizer(tokenizer.vocav, tokenizer.merges, special_tokens + [f'<|reserved_{i}|>' for i in range(250)])
+elapsed = (time.time() - start_time) / num_inits
+print(f"init ({len(tokenizer.vocav)} tokens, {len(special_tokens) + 250} special tokens): {1000 * elapsed:.2f} ms")
+
+# startup of a worker - from a tokenizer file, mapped instead of parsed
+tokenizer_file = os.path.join(tempfile.mkdtemp(), "gpt2.tok")
+save_tokenizer_file(tokenizer_file, tokenizer.vocav, tokenizer.merges, special_tokens)
+start_time = time.time()
+for _ in range(num_inits):
+    Tokenizer.from_file(tokenizer_file)
+elapsed = (time.time() - start_time) / num_inits
+print(f"init from file: {1000 * elapsed:.2f} ms")
+num_bytes = len(text.encode("utf-8"))
+
+start_time = time.time()
+for _ in range(repeats):
+    ids = tokenizer.encode(text)
+elapsed = (time.time() - start_time) / repeats
+
+print(f"encode: {num_bytes / 1e6 / elapsed:.3f} MB/s | {len(ids) / elapsed:.0f} tokens/s | {1000 * elapsed:.2f} ms")
+print(f"pre-token cache: {tokenizer.cache_info()}")
+
+# per-call overhead on short strings (e.g. encode_iterable over a line-oriented file)
+short_texts = ['Hello, world!\n', 'Once upon a time<|endoftext|>', '\n']
+num_calls = 20000
+start_time = time.time()
+for i in range(num_calls):
+    tokenizer.encode(short_texts[i % len(short_texts)])
+elapsed = time.time() - start_time
+print(f"encode (short strings): {1e6 * elapsed / num_calls:.2f} us/call")
+
+# decode, at once and streamed id by id
+start_time = time.time()
+for _ in range(repeats):
+    decoded = tokenizer.decode(ids)
+elapsed = (time.time() - start_time) / repeats
+print(f"decode: {len(ids) / elapsed:.0f} tokens/s")
+start_time = time.time()
+for _ in range(repeats):
+    decoded = "".join(tokenizer.decode_iterable(ids))
+elapsed = (time.time() - start_time) / repeats
+print(f"decode_iterable: {1e6 * elapsed / len(ids):.2f} us/token")
+
+# special token splitting with many control tokens (chat templates, reserved tokens)
+many_special_tokens = special_tokens + ['<|im_start|>', '<|im_end|>'] + [f'<|reserved_{i}|>' for i in range(250)]
+many_tokenizer = get_tokenizer_from_vocab_merges_path(vocab_path=VOCAB_PATH, merges_path=MERGES_PATH,
+                                                      special_tokens=many_special_tokens)
+chat_text = text.replace('. ', '.<|im_end|><|im_start|> ').replace('\n', '<|reserved_17|>\n')
+start_time = time.time()
+for _ in range(repeats):
+    many_tokenizer.pre_tokenize(chat_text)
+elapsed = (time.time() - start_time) / repeats
+print(f"pre-tokenize ({len(many_special_tokens)} special tokens): {len(chat_text) / 1e6 / elapsed:.3f} M chars/s")
@@ -0,0 +1,26 @@
+import time
+
+from cs336_basics.train_bpe import train_bpe
+
+# args - same corpus as `test_train_bpe_speed`
+text_source = 'tests/fixtures/corpus.en'
+special_tokens = ['<|endoftext|>']
+vocab_sizes = [1000, 10*(10**3), 32*(10**3)]
+
+for vocab_size in vocab_sizes:
+    # seconds of each phase, from the phase_end records
+    phase_seconds = {}
+    def progress(record):
+        if record["event"] == "phase_end":
+            phase_seconds[record["phase"]] = record["seconds"]
+
+    start_time = time.time()
+    vocab, merges = train_bpe(input_path=text_source, vocab_size=vocab_size, special_tokens=special_tokens,
+                              progress=progress)
+    elapsed = time.time() - start_time
+
+    # the corpus can run out of pairs before reaching big vocab sizes
+    merging = phase_seconds["merging"]
+    print(f"vocab_size: {vocab_size} | merges: {len(merges)} | total: {elapsed:.2f} s"
+          f" | pre-tokenization: {phase_seconds['pre_tokenization']:.2f} s | merging: {merging:.2f} s"
+          f" | per merge: {1000 * merging / max(len(merges), 1):.3f} ms")
@@ -1,32 +1,29 @@
-import numpy as np
-import tqdm
+import os
 
+from cs336_basics.data import tokenize_to_bin, tokenize_to_shards
+from cs336_basics.progress import TqdmProgress
 from cs336_basics.tokenizer import Tokenizer
 
 owt_conf = {
     'train':'data/raw/owt_train.txt',
     'val':'data/raw/owt_valid.txt',
-    'vocab_filepath': 'data/out/owt_vocab.json',
-    'merges_filepath': 'data/out/owt_merges.txt',
-    'special_tokens': ['<|endoftext|>']
+    'tokenizer_filepath': 'data/out/owt_32000.tok',  # written by train_bpe_owt.py
+    'output_dir': 'data/owt/{split}',  # shards + manifest.json, read with load_token_dataset
+    'output_filepath': 'data/owt/{split}.bin',  # with concatenate = True
 }
+num_workers = os.cpu_count()
+concatenate = False  # one flat .bin per split instead of the shards
 
-tokenizer = Tokenizer.from_files(merges_filepath=owt_conf['merges_filepath'], 
-                                 vocab_filepath=owt_conf['vocab_filepath'],
-                                 special_tokens=owt_conf['special_tokens'])
+tokenizer = Tokenizer.from_file(owt_conf['tokenizer_filepath'])
 
 for split in ['train', 'val']:
-    with open(owt_conf[split]) as f:
-        text = f.read()
-    encoded = tokenizer.encode(text)
-
-    # save the ids
-    total_batches = 1024
-    batch_size = len(encoded) // total_batches
-    arr = np.memmap(f'data/owt/{split}.bin', dtype=np.uint16, mode='w+', shape=(len(encoded),))
-    idx = 0
-    for batch_idx in tqdm(range(total_batches), desc=f'Writing {split}.bin'):
-        batch = encoded[idx:idx+batch_size]
-        arr[idx:idx+batch_size] = batch
-        idx += batch_size
-arr.flush()
\ No newline at end of file
+    # split at documents, tokenize the shards in parallel and stream the uint16 ids to disk.
+    # Resumable - running again skips the shards that are done
+    if concatenate:
+        num_tokens = tokenize_to_bin(owt_conf[split], owt_conf['output_filepath'].format(split=split), tokenizer,
+                                     num_workers=num_workers, progress=TqdmProgress())
+    else:
+        manifest = tokenize_to_shards(owt_conf[split], owt_conf['output_dir'].format(split=split), tokenizer,
+                                      num_workers=num_workers, progress=TqdmProgress())
+        num_tokens = manifest['num_tokens']
+    print(f"{split}: {num_tokens} tokens")
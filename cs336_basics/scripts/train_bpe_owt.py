@@ -1,19 +1,19 @@
-from cs336_basics.train_bpe import train_bpe
-import pickle
+from cs336_basics.progress import JsonLinesProgress, TqdmProgress
+from cs336_basics.train_bpe import save_tokenizer_file, train_bpe
+import os
 
 # args
 text_source = 'data/raw/owt_train.txt'
-output_vocab_path = 'data/out/owt_vocab.pkl'
-output_merge_path = 'data/out/owt_merges.pkl'
+output_path = 'data/out/owt_{vocab_size}.tok'  # binary tokenizer file, load with Tokenizer.from_file
 special_tokens = ['<|endoftext|>']
-vocab_size = 32*(10**3)
+vocab_sizes = [8*(10**3), 16*(10**3), 32*(10**3)]  # nested vocabs - a single training run
+progress_log_path = None  # e.g. 'data/out/owt_bpe_progress.jsonl' for machine readable progress
 
 # training
-vocab, merges = train_bpe(input_path=text_source, vocab_size=vocab_size, special_tokens=special_tokens)
+tokenizers = train_bpe(input_path=text_source, vocab_size=vocab_sizes, special_tokens=special_tokens,
+                       num_workers=os.cpu_count(),
+                       progress=JsonLinesProgress(progress_log_path) if progress_log_path else TqdmProgress())
 
-# Serialize and save the vocab and merges
-with open(output_vocab_path, "wb") as f:
-    pickle.dump(merges, f) 
-
-with open(output_vocab_path, "wb") as f:
-    pickle.dump(vocab, f) 
\ No newline at end of file
+# Serialize and save the vocab, merges and special tokens
+for vocab_size, (vocab, merges) in tokenizers.items():
+    save_tokenizer_file(output_path.format(vocab_size=vocab_size), vocab, merges, special_tokens)
@@ -1,34 +1,125 @@
+import codecs
+from collections import OrderedDict
 from collections.abc import Iterable
+from functools import cached_property, partial
+from itertools import islice
+from multiprocessing import Pool
+import os
 import pickle
-import regex as re
+import numpy as np
+
+from cs336_basics.pretokenize import SpecialTokenMatcher, iter_pre_tokens, stream_pre_tokens
+from cs336_basics.train_bpe import load_tokenizer_file, map_tokenizer_file
+
+REPLACEMENT_BYTES = "\uFFFD".encode("utf-8")
 
 class Tokenizer:
 
-    def __init__(self, vocab : dict[int, bytes], merges : list[tuple[bytes, bytes]], special_tokens : list[str] | None = None):
+    def __init__(self, vocab : dict[int, bytes], merges : list[tuple[bytes, bytes]], special_tokens : list[str] | None = None,
+                 cache_size : int = 100_000):
         """
 
         Construct a tokenizer from a given vocabulary, list of merges, and (optionally) a list of special tokens.
 
-        
+        The ids of the most recent `cache_size` distinct pre-tokens are cached (LRU), natural text repeats
+        a small set of pre-tokens so most of them skip BPE. `cache_size=0` disables the cache.
         """
-        self.vocav = vocab
+        # a copy, adding the special tokens must not change the caller's vocab
+        self.vocav = dict(vocab)
         self.merges = merges
         self.special_tokens = None
 
+        # inverse vocabulary lookup, built once and also used to check which special tokens are already there
+        self.inv_vocab = {v : k for k, v in self.vocav.items()}
 
         # adding special_token to our vocabulary if not exists already
+        self.special_token_bytes = set()
         if special_tokens is not None:
             self.special_tokens = sorted(special_tokens,reverse=True)
+            self.special_token_bytes = {t.encode("utf-8") for t in special_tokens}
             for special_token in special_tokens:
                 special_token = special_token.encode("utf-8")
-                if special_token not in self.vocav.values():
+                if special_token not in self.inv_vocab:
+                    self.inv_vocab[special_token] = len(self.vocav)
                     self.vocav[len(self.vocav)] = special_token
 
-        # inverse vocabulary lookup 
-        self.inv_vocab = {v : k for k, v in vocab.items()}
+        # merges as packed id pairs, the ids they make are looked up on first use (see `bpe`)
+        inv_vocab = self.inv_vocab
+        try:
+            merge_keys = [inv_vocab[left] << 32 | inv_vocab[right] for left, right in merges]
+        except KeyError as e:
+            raise ValueError(f"merge token {e.args[0]!r} is not in the vocab") from None
+
+        # dense id -> bytes table for decoding, ids missing from the vocab decode as U+FFFD
+        self.id_to_bytes = [REPLACEMENT_BYTES] * (max(self.vocav, default=-1) + 1)
+        for token_id, token in self.vocav.items():
+            self.id_to_bytes[token_id] = token
+
+        single_bytes = [bytes([b]) for b in range(256)]
+        self._init_encoder(
+            special_ids={token: inv_vocab[token] for token in self.special_token_bytes},
+            byte_ids={token[0]: inv_vocab[token] for token in single_bytes if token in inv_vocab},
+            merge_keys=merge_keys,
+            merged_ids=[None] * len(merge_keys),
+            max_id=max(self.vocav, default=0),
+            cache_size=cache_size,
+        )
+
+    def _init_encoder(self, special_ids, byte_ids, merge_keys, merged_ids, max_id, cache_size):
+        # the tables encoding works with, all keyed by token ids
+        self.special_ids = special_ids
+        self.byte_ids = byte_ids
+
+        # special token matcher, compiled once
+        self.special_matcher = SpecialTokenMatcher(self.special_tokens or [])
+
+        # merge ranks keyed by the packed id pair (left << 32 | right) - the earlier a merge was created,
+        # the earlier it is applied - and the id made by the merge of each rank (None until it is looked up)
+        self.merge_ranks = dict(zip(merge_keys, range(len(merge_keys))))
+        self.merged_ids = merged_ids
+
+        # pre-token -> ids LRU cache
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # smallest dtype holding every token id
+        self.dtype = np.dtype(np.uint16) if max_id < 2**16 else np.dtype(np.uint32)
+
+        # encode_batch workers, started lazily
+        self._pool = None
+        self._pool_workers = 0
+
+    @cached_property
+    def vocav(self) -> dict[int, bytes]:
+        # set by __init__, built from the mapped file on first use by `from_file`
+        ids, offsets, blob, _ = self._file_tables
+        blob = blob.tobytes()
+        offsets = offsets.tolist()
+        return dict(zip(ids.tolist(), [blob[start:end] for start, end in zip(offsets, offsets[1:])]))
+
+    @cached_property
+    def inv_vocab(self) -> dict[bytes, int]:
+        return {v : k for k, v in self.vocav.items()}
+
+    @cached_property
+    def merges(self) -> list[tuple[bytes, bytes]]:
+        # set by __init__, built from the mapped file on first use by `from_file`
+        vocab = self.vocav
+        return [(vocab[left], vocab[right]) for left, right in self._file_tables[3].tolist()]
+
+    @cached_property
+    def id_to_bytes(self) -> list[bytes]:
+        # set by __init__, built from the mapped file on first use by `from_file`
+        id_to_bytes = [REPLACEMENT_BYTES] * (max(self.vocav, default=-1) + 1)
+        for token_id, token in self.vocav.items():
+            id_to_bytes[token_id] = token
+        return id_to_bytes
 
     @classmethod
-    def from_files(cls, vocab_filepath : str, merges_filepath : str, special_tokens : list[str] | None = None):
+    def from_files(cls, vocab_filepath : str, merges_filepath : str, special_tokens : list[str] | None = None,
+                   cache_size : int = 100_000):
         """
         Class methos that constructs and return a Tokenizer from a serialized vocabulary
         and a list of merges (in the format created by [train_bpe.py] and (optionally) a
@@ -44,77 +135,276 @@ class Tokenizer:
         except Exception as  e:
             print(f"An error occured during deserialization: {e}")
 
-        return cls(vocab, merges, special_tokens)
+        return cls(vocab, merges, special_tokens, cache_size)
     
-    def pre_tokenize(self, text, special_tokens):
-        PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
-        pre_tokens = list()
+    @classmethod
+    def from_file(cls, filepath : str, special_tokens : list[str] | None = None, cache_size : int = 100_000):
+        """
+        Constructs a Tokenizer from a single binary tokenizer file (written by `train_bpe.save_tokenizer_file`),
+        the special tokens stored in the file are used unless `special_tokens` is given.
 
-        parts = [text]
-        if special_tokens is not None:
-            split_pat = "(" + "|".join(re.escape(t) for t in special_tokens) + ")"
-            parts = re.split(split_pat, text)
-
-        for part in parts:
-            if not part:
-                continue
-            if special_tokens is not None and part in special_tokens:
-                pre_tokens.append([part.encode("utf-8")])
-                continue
-            for pretoken in re.finditer(PAT, part):
-                token_bytes = pretoken.group(0).encode("utf-8")
-                pre_token = tuple(token_bytes[i:i+1] for i in range(len(token_bytes)))
-                pre_tokens.append(pre_token)
-
-        return pre_tokens
+        The file is mapped and the encoding tables are built straight from its id sections, without building the
+        vocab or the merges, so that workers start fast. `vocav`, `inv_vocab`, `merges` and the decoding table are
+        built from the mapped file on first use. Special tokens that are not in the file need the whole vocab,
+        they go through the constructor.
+        """
+        ids, offsets, blob, merge_ids, merged_ids, special_ids = map_tokenizer_file(filepath)
+        # the ids are increasing: token `token_id` is at index searchsorted(ids, token_id)
+        special_indices = np.searchsorted(ids, special_ids)
+        file_special_ids = {blob[start:end].tobytes(): token_id for start, end, token_id in
+                            zip(offsets[special_indices].tolist(), offsets[special_indices + 1].tolist(),
+                                special_ids.tolist())}
+        if special_tokens is None:
+            special_tokens = [token.decode("utf-8") for token in file_special_ids] or None
+        elif any(token.encode("utf-8") not in file_special_ids for token in special_tokens):
+            vocab, merges, _ = load_tokenizer_file(filepath)
+            return cls(vocab, merges, special_tokens, cache_size)
+
+        tokenizer = cls.__new__(cls)
+        tokenizer._file_tables = (ids, offsets, blob, merge_ids)
+        tokenizer.special_tokens = sorted(special_tokens, reverse=True) if special_tokens is not None else None
+        tokenizer.special_token_bytes = {t.encode("utf-8") for t in special_tokens or []}
+        single_bytes = np.flatnonzero(np.diff(offsets) == 1)
+        tokenizer._init_encoder(
+            special_ids={token: file_special_ids[token] for token in tokenizer.special_token_bytes},
+            byte_ids=dict(zip(blob[offsets[single_bytes]].tolist(), ids[single_bytes].tolist())),
+            merge_keys=(merge_ids[:, 0].astype(np.uint64) << np.uint64(32) | merge_ids[:, 1]).tolist(),
+            merged_ids=merged_ids.tolist(),
+            max_id=int(ids[-1]) if len(ids) else 0,
+            cache_size=cache_size,
+        )
+        return tokenizer
+
+    def pre_tokenize(self, text):
+        """
+        Split `text` into pre-tokens (as utf-8 bytes), special tokens are kept whole.
+        """
+        return list(iter_pre_tokens(text, self.special_matcher))
+
+    def bpe(self, pre_token: bytes) -> list[int]:
+        """
+        Encode a single pre-token: repeatedly merge the adjacent pair with the lowest merge rank
+        (as tiktoken does), instead of going over the whole list of merges.
+        The pre-token is merged as ids, a pair is looked up with its two ids packed into one int.
+        """
+        merge_ranks = self.merge_ranks
+        word = [self.byte_ids[b] for b in pre_token]
+        while len(word) > 1:
+            best_rank = None
+            for left, right in zip(word[:-1], word[1:]):
+                rank = merge_ranks.get(left << 32 | right)
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank, best_left, best_right = rank, left, right
+            if best_rank is None:
+                break
+
+            # merge every occurence of the best pair
+            merged = self.merged_ids[best_rank]
+            if merged is None:
+                merged = self.inv_vocab[self.id_to_bytes[best_left] + self.id_to_bytes[best_right]]
+                self.merged_ids[best_rank] = merged
+            new_word = []
+            idx = 0
+            while idx < len(word):
+                if idx < len(word) - 1 and word[idx] == best_left and word[idx+1] == best_right:
+                    new_word.append(merged)
+                    idx += 2
+                else:
+                    new_word.append(word[idx])
+                    idx += 1
+            word = new_word
+
+        return word
+
+    def bpe_cached(self, pre_token: bytes) -> list[int] | tuple[int, ...]:
+        """
+        `bpe` behind the bounded LRU cache.
+        """
+        ids = self.cache.get(pre_token)
+        if ids is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(pre_token)
+            return ids
+
+        self.cache_misses += 1
+        ids = self.bpe(pre_token)
+        if self.cache_size > 0:
+            self.cache[pre_token] = tuple(ids)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ids
+
+    def cache_info(self) -> dict[str, int]:
+        """
+        Counters of the pre-token cache, to size it.
+        """
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "maxsize": self.cache_size, "currsize": len(self.cache)}
 
     def encode(self, text: str) -> list[int]:
 
         # pre-tokenization
-        pre_tokens = self.pre_tokenize(text, self.special_tokens)
+        pre_tokens = self.pre_tokenize(text)
+        return self._encode_pre_tokens(pre_tokens)
 
-        # apply merges in the same order as in merges
-        pre_token_id = 0
-        while pre_token_id < len(pre_tokens):
-            pre_token = pre_tokens[pre_token_id]
-            updated_pre_token = list(pre_token)
-            if (len(pre_token) > 1):
-                for merge in self.merges:
-                    idx = 0
-                    while idx < len(pre_token) and len(pre_token) > 1:
-                        if pre_token[idx:idx+2] == merge:
-                            updated_pre_token[idx] = pre_token[idx] + pre_token[idx+1]
-                            updated_pre_token.pop(idx+1)
-                            pre_token = tuple(updated_pre_token) 
-                        
-                        idx += 1
-                
-            # now encode using the vocabulary
-            pre_tokens[pre_token_id] = [self.inv_vocab[tok] for tok in pre_token]
-            pre_token_id += 1
+    def _encode_pre_tokens(self, pre_tokens: list[bytes]) -> list[int]:
+        return list(self._iter_ids(pre_tokens))
 
-        pre_tokens = [item for sublist in pre_tokens for item in sublist]
-        return pre_tokens
+    def _iter_ids(self, pre_tokens: list[bytes]) -> Iterable[int]:
 
+        # apply merges by rank, special tokens map to their id as is
+        for pre_token in pre_tokens:
+            if len(pre_token) == 1:
+                yield self.byte_ids[pre_token[0]]
+            elif pre_token in self.special_ids:
+                yield self.special_ids[pre_token]
+            else:
+                yield from self.bpe_cached(pre_token)
 
+    def encode_to_array(self, text: str, dtype=None) -> np.ndarray:
+        """
+        `encode` into a NumPy array, without building the list of Python ints.
+        `dtype` defaults to the smallest unsigned type holding the vocab (uint16 up to 65536 tokens, else uint32).
+        """
+        pre_tokens = self.pre_tokenize(text)
+        return np.fromiter(self._iter_ids(pre_tokens), dtype=dtype or self.dtype)
 
+    def encode_iterable_to_array(self, iterable: Iterable[str], out: np.ndarray | None = None, dtype=None,
+                                 block_size: int = 1 << 20) -> np.ndarray:
+        """
+        Streaming counterpart of `encode_to_array` (over `encode_iterable`), the ids are written `block_size` at a time
+        into `out` (e.g. a preallocated `np.memmap`, a ValueError is raised if it is too small)
+        or, when `out` is None, into a buffer growing by doubling.
 
-    def encode_iterable(self, iterable: Iterable[str]) -> Iterable[int]:
+        Returns the filled part of the buffer.
+        """
+        dtype = np.dtype(dtype or (out.dtype if out is not None else self.dtype))
+        growable = out is None
+        if growable:
+            out = np.empty(block_size, dtype=dtype)
+
+        ids = self.encode_iterable(iterable)
+        size = 0
+        while True:
+            block = np.fromiter(islice(ids, block_size), dtype=dtype)
+            if len(block) == 0:
+                break
+            if size + len(block) > len(out):
+                if not growable:
+                    raise ValueError(f"output buffer of {len(out)} tokens is too small")
+                out = np.resize(out, max(2 * len(out), size + len(block)))
+            out[size:size + len(block)] = block
+            size += len(block)
+
+        return out[:size]
+
+    def encode_batch(self, texts: list[str], num_workers: int | None = None) -> list[list[int]]:
+        """
+        Encode many independent texts in parallel, returns their ids in the input order (same as `encode` on each).
+
+        The worker pool is started on the first call and kept for the next ones, every worker gets its own
+        copy of the tokenizer once (the tables are not sent again with each task). `close()` stops it.
+        """
+        num_workers = num_workers or os.cpu_count() or 1
+        if num_workers == 1 or len(texts) <= 1:
+            return [self.encode(text) for text in texts]
+
+        if self._pool is None or self._pool_workers != num_workers:
+            self.close()
+            self._pool = Pool(num_workers, initializer=_init_worker, initargs=(self,))
+            self._pool_workers = num_workers
+
+        chunksize = max(1, len(texts) // (4 * num_workers))
+        return self._pool.map(_encode_worker, texts, chunksize=chunksize)
+
+    def close(self):
+        """
+        Stop the `encode_batch` worker pool.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __getstate__(self):
+        # the worker pool can't be pickled, and the copy starts with an empty cache
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["cache"] = OrderedDict()
+        return state
+
+    def encode_iterable(self, iterable: Iterable[str], buffer_size: int = 1 << 16) -> Iterable[int]:
         """
         Given an iterable of strings(e.g. a Python file handle), 
         return a generator that laizily yields token IDs.
 
         This is required for memoery-efficient tokenization of large files that we cannot directly load
         into memory.
+
+        The input is encoded in buffers of about `buffer_size` characters, whatever its line structure
+        (a file-like object is read `buffer_size` characters at a time, short items of an iterable are joined).
+        The unfinished tail of a buffer - its last two pre-tokens or a partial special token - is carried to the next
+        one, so the ids are the same as `encode` on the whole text.
         """
-        for line in iterable:
-            for token_id in self.encode(line):
-                yield token_id
+        if hasattr(iterable, "read"):
+            iterable = iter(partial(iterable.read, buffer_size), "")
+
+        yield from self._iter_ids(stream_pre_tokens(iterable, self.special_matcher, buffer_size=buffer_size))
 
     def decode(self, ids: list[int]) -> str:
         """
         Decode a sequance of token IDs into text.
+        Unknown ids and invalid utf-8 bytes are decoded as U+FFFD.
+        """
+        table = self.id_to_bytes
+        size = len(table)
+        data = b"".join([table[id] if 0 <= id < size else REPLACEMENT_BYTES for id in ids])
+        return data.decode("utf-8","replace")
+
+    def incremental_decoder(self) -> "IncrementalDecoder":
+        """
+        A decoder to feed ids step by step (e.g. while generating), see `IncrementalDecoder`.
+        """
+        return IncrementalDecoder(self)
+
+    def decode_iterable(self, ids: Iterable[int]) -> Iterable[str]:
         """
-        str = [self.vocav.get(id, '\uFFFD') for id in ids]
-        str = b"".join(str)
-        return str.decode("utf-8","replace")
\ No newline at end of file
+        Lazily decode a stream of token IDs, yielding text as soon as it forms complete utf-8 characters.
+        The concatenated pieces are equal to `decode` of all the ids.
+        """
+        decoder = self.incremental_decoder()
+        for id in ids:
+            text = decoder.decode([id])
+            if text:
+                yield text
+        text = decoder.flush()
+        if text:
+            yield text
+
+class IncrementalDecoder:
+    """
+    Decode ids step by step without re-decoding the prefix: `decode` returns the text of all
+    the complete utf-8 characters so far, the bytes of a partial character wait for the next ids.
+    `flush` returns what's left at the end (a partial character is decoded as U+FFFD).
+    """
+    def __init__(self, tokenizer: Tokenizer):
+        self.table = tokenizer.id_to_bytes
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def decode(self, ids: Iterable[int]) -> str:
+        table = self.table
+        size = len(table)
+        return self.decoder.decode(b"".join([table[id] if 0 <= id < size else REPLACEMENT_BYTES for id in ids]))
+
+    def flush(self) -> str:
+        return self.decoder.decode(b"", final=True)
+
+
+# encode_batch worker state - one tokenizer per worker process, built once by the pool initializer
+_worker_tokenizer = None
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _encode_worker(text):
+    return _worker_tokenizer.encode(text)
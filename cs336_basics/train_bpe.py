@@ -1,135 +1,745 @@
-import regex as re
+from array import array
+import codecs
+from collections import Counter, defaultdict
+from collections.abc import Callable
+import hashlib
+import heapq
+import itertools
+import json
+from multiprocessing import Pool
+import operator
+import os
+import pickle
+import struct
+import time
+import numpy as np
 
-def read_in_chunks(path, chunk_size=10*1024*1024):  # 10 Mb
-    with open(path, "r", encoding="utf8") as f:
-        while True:
-            chunk = f.read(chunk_size)
+from cs336_basics.chunking import find_chunk_boundaries
+from cs336_basics.pretokenize import PAT, SpecialTokenMatcher, iter_pre_tokens, stream_pre_tokens
+from cs336_basics.progress import Phase
+
+def read_in_chunks(path, chunk_size=10*1024*1024, start=0, end=None):  # 10 Mb
+    """
+    Yield the text of the byte range [`start`, `end`) of the file, reading `chunk_size` bytes at a time.
+    A utf-8 character cut by a chunk border is completed in the next chunk.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
             if not chunk:
                 break
-            yield chunk
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield decoder.decode(chunk)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
 
-def train_bpe(input_path: str, vocab_size: int, special_tokens: list[str]): 
+def pre_tokenize_text(text: str, special_tokens: list[str]) -> Counter:
+    """
+    Count the pre-tokens of `text` (as utf-8 bytes), special tokens are split out and dropped.
+    """
+    return Counter(iter_pre_tokens(text, SpecialTokenMatcher(special_tokens), keep_special=False))
+
+def pre_tokenize_stream(chunks, special_tokens: list[str]) -> Counter:
+    """
+    Count the pre-tokens of a text given as an iterable of pieces (e.g. `read_in_chunks`), memory is bounded by
+    the piece size and the number of unique pre-tokens. The counts are the same as `pre_tokenize_text` over the
+    whole text.
+    """
+    return Counter(stream_pre_tokens(chunks, SpecialTokenMatcher(special_tokens), keep_special=False))
+
+def _timed(chunks, timer):
+    # yield from `chunks`, adding the time spent producing them to timer[0]
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        timer[0] += time.perf_counter() - start
+        if chunk is None:
+            return
+        yield chunk
+
+def _count_chunk(args):
+    # worker: count the pre-tokens in the [start, end) byte range of the file,
+    # returns the counts and the seconds spent reading / pre-tokenizing
+    input_path, start, end, special_tokens, chunk_size = args
+    start_time = time.perf_counter()
+    if chunk_size is None:
+        with open(input_path, "rb") as f:
+            f.seek(start)
+            text = f.read(end - start).decode("utf-8")
+        read_seconds = time.perf_counter() - start_time
+        counts = pre_tokenize_text(text, special_tokens)
+    else:
+        timer = [0.0]
+        counts = pre_tokenize_stream(_timed(read_in_chunks(input_path, chunk_size, start, end), timer), special_tokens)
+        read_seconds = timer[0]
+    return counts, read_seconds, time.perf_counter() - start_time - read_seconds
+
+CHUNKS_PER_WORKER = 4
+
+def count_pre_tokens(
+    input_path,
+    special_tokens: list[str],
+    num_workers: int = 1,
+    chunk_size: int | None = None,
+    stats: dict | None = None,
+) -> dict[bytes, int]:
+    """
+    Pre-tokenize the file at `input_path` and return the frequency of every pre-token (as utf-8 bytes).
+
+    With `num_workers > 1` the file is split at special tokens into `CHUNKS_PER_WORKER` chunks per worker
+    (using `chunking.find_chunk_boundaries`) and the chunks are counted in a process pool, the extra chunks
+    keep the workers busy when some chunks are slower than others.
+    The result is the same as the serial path since no chunk starts in the middle of a document.
+
+    With `chunk_size` set, every worker streams its part of the file `chunk_size` bytes at a time
+    instead of loading it as one string.
+
+    If `stats` is given, the seconds spent reading and pre-tokenizing (summed over the workers) are added to it.
+    """
+    if num_workers > 1 and special_tokens:
+        boundaries = find_chunk_boundaries(input_path, CHUNKS_PER_WORKER * num_workers,
+                                           [t.encode("utf-8") for t in special_tokens])
+    else:
+        with open(input_path, "rb") as f:
+            f.seek(0, 2)
+            boundaries = [0, f.tell()]
+
+    jobs = [(input_path, start, end, special_tokens, chunk_size) for start, end in zip(boundaries[:-1], boundaries[1:])]
+    if len(jobs) > 1:
+        counts = Counter()
+        read_seconds = pre_tokenize_seconds = 0.0
+        with Pool(min(num_workers, len(jobs))) as pool:
+            for chunk_counts, chunk_read, chunk_pre_tokenize in pool.imap_unordered(_count_chunk, jobs):
+                counts.update(chunk_counts)
+                read_seconds += chunk_read
+                pre_tokenize_seconds += chunk_pre_tokenize
+    else:
+        counts, read_seconds, pre_tokenize_seconds = _count_chunk(jobs[0]) if jobs else (Counter(), 0.0, 0.0)
+
+    if stats is not None:
+        stats["read_seconds"] = stats.get("read_seconds", 0.0) + read_seconds
+        stats["pre_tokenize_seconds"] = stats.get("pre_tokenize_seconds", 0.0) + pre_tokenize_seconds
+    return dict(counts)
+
+def train_bpe(
+    input_path: str,
+    vocab_size: int | list[int],
+    special_tokens: list[str],
+    num_workers: int = 1,
+    chunk_size: int | None = None,
+    checkpoint_path: str | None = None,
+    checkpoint_every: int | None = None,
+    checkpoint_seconds: float | None = None,
+    resume_from: str | None = None,
+    cache_dir: str | None = None,
+    cache_max_bytes: int = 4 * 1024**3,
+    initial_merges: list[tuple[bytes, bytes]] | None = None,
+    progress: Callable[[dict], None] | None = None,
+    progress_every: int = 100,
+):
     """
     An implementation of the BPE algorithm, training a vocabulary of a given `vocab_size`
 
     Returns `vocab` the generated vocabulary and `merges` holding the merging stpes between pairs.
 
+    `vocab_size` can also be a list of sizes: the merges of a smaller vocab are a prefix of the merges
+    of a bigger one, so a single run up to the biggest size gives all of them.
+    Returns then a dict `{vocab_size: (vocab, merges)}`.
+
     Usage:
         - `input_path` - path for text file for training
         - `vocab_size` - in addition to 255 byte mappings, how much the vocabolary can grow
         - `special_tokens` -  tokens to add as is to the vocaublary, they won't be tokenized.
+        - `num_workers` - number of processes used for pre-tokenization (1 = serial)
+        - `chunk_size` - if set, stream the corpus in pieces of `chunk_size` bytes (bounded memory)
+        - `checkpoint_path` - if set, the merge state is saved there every `checkpoint_every` merges
+          and/or every `checkpoint_seconds` seconds, and once more when training ends
+        - `resume_from` - path of a checkpoint to continue from, the pre-tokenization is skipped.
+          The result is identical to an uninterrupted run.
+        - `cache_dir` - if set, the pre-token counts are cached there (keyed by the corpus content,
+          `PAT` and `special_tokens`), so training again on the same corpus skips pre-tokenization.
+          The oldest entries are evicted once the cache exceeds `cache_max_bytes`.
+        - `initial_merges` - warm start from an existing list of merges (e.g. a released tokenizer):
+          they are applied to the pre-tokens at once, then training continues up to `vocab_size`.
+        - `progress` - callback receiving structured progress records (dicts, see `cs336_basics.progress.Phase`):
+          wall time and peak RSS of every phase, and every `progress_every` merges the merges per second,
+          the size of the pair table and the count of the current best pair.
+          Quiet by default, `JsonLinesProgress` and `TqdmProgress` are ready-made sinks.
 
-        train_bpe(input_path: str, vocab_size: int, special_tokens: list[str])
+        train_bpe(input_path: str, vocab_size: int, special_tokens: list[str], num_workers: int = 1,
+                  chunk_size: int | None = None, checkpoint_path: str | None = None,
+                  checkpoint_every: int | None = None, checkpoint_seconds: float | None = None,
+                  resume_from: str | None = None, cache_dir: str | None = None,
+                  cache_max_bytes: int = 4 * 1024**3,
+                  initial_merges: list[tuple[bytes, bytes]] | None = None,
+                  progress: Callable[[dict], None] | None = None, progress_every: int = 100)
 
     """
-    
-    # vocab init
-    vocab = {i: bytes([i]) for i in range(256)}
-    for i, token in enumerate(special_tokens):
-        vocab[256+i] = token.encode("utf-8")
+    vocab_sizes = None
+    if isinstance(vocab_size, (list, tuple)):
+        vocab_sizes = sorted(vocab_size)
+        vocab_size = vocab_sizes[-1]
+    num_initial = len(initial_merges) if initial_merges is not None else 0
+    typecode = "H" if max(vocab_size, 256 + len(special_tokens) + num_initial) <= 2**16 else "I"
 
-    # Pre-tokenization
-    print("init - pre-tokenization")
-    PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
-    pre_tokens = {}
-    
-    try:
-        with open(input_path, "r", encoding="utf8") as file:
-            text = file.read()
-       
-            split_pat = "(" + "|".join(re.escape(t) for t in special_tokens) + ")"
-            parts = re.split(split_pat, text)
-
-            for part in parts:
-                if not part:
-                    continue
-                if part in special_tokens:
-                    continue
-                for pretoken in re.finditer(PAT, part):
-                    token_bytes = pretoken.group(0).encode("utf-8")
-                    key = tuple(token_bytes[i:i+1] for i in range(len(token_bytes)))
-                    pre_tokens[key] = pre_tokens.get(key, 0) + 1
-
-
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-        
-    # compute byte-pair stat 
-    print("init - BP stat")
-    pairs_stat = dict()
-    for pre_token in pre_tokens:
-        # count byte-pairs per pre-token
-        for x,y in zip(pre_token[:-1],pre_token[1:]):
-            pairs_stat[(x,y)] = pairs_stat.get((x,y), 0) + pre_tokens[pre_token]
+    if resume_from is not None:
+        with Phase(progress, "resume") as phase:
+            words, freqs, token_bytes, merges = load_bpe_checkpoint(resume_from, special_tokens, typecode)
+            phase.metrics["num_merges"] = len(merges)
+    else:
+        # vocab init - `token_bytes[token_id]` holds the bytes of each token
+        token_bytes = [bytes([i]) for i in range(256)]
+        for token in special_tokens:
+            token_bytes.append(token.encode("utf-8"))
+
+        # Pre-tokenization
+        with Phase(progress, "pre_tokenization") as phase:
+            cached = None
+            if cache_dir is not None:
+                cache_key = pre_token_cache_key(input_path, special_tokens, cache_dir)
+                cached = load_cached_pre_tokens(cache_dir, cache_key)
+            phase.metrics["cached"] = cached is not None
+            if cached is not None:
+                pre_tokens = cached
+            else:
+                pre_tokens = count_pre_tokens(input_path, special_tokens, num_workers, chunk_size, phase.metrics)
+                if cache_dir is not None:
+                    save_cached_pre_tokens(cache_dir, cache_key, pre_tokens, cache_max_bytes)
+            phase.metrics["num_pre_tokens"] = len(pre_tokens)
+
+        words = Words.from_pre_tokens(pre_tokens, typecode)
+        freqs = list(pre_tokens.values())
+        del pre_tokens
+        merges = list()
+
+        if initial_merges is not None:
+            with Phase(progress, "initial_merges"):
+                merges = apply_initial_merges(words, token_bytes, initial_merges)
+
+    # compute byte-pair stat
+    with Phase(progress, "pair_counting") as phase:
+        pairs_stat, pair_index = count_pairs(words, freqs)
+        token_keys = [reverse_key(token) for token in token_bytes]
+        pair_heap = [heap_entry(count, pair, token_keys) for pair, count in pairs_stat.items()]
+        heapq.heapify(pair_heap)
+        phase.metrics["num_pairs"] = len(pairs_stat)
 
     # bpe merge
-    print("init - merges")
-    merges = list()
-    while len(vocab) < vocab_size:
-        pre_tokens, pairs_stat, vocab, merges = bpe_merge(pre_tokens, pairs_stat, vocab, merges)
-        voc_l = len(vocab)
-        if voc_l % 100 == 0:
-            print("vocab:",len(vocab))
+    with Phase(progress, "merging", total=max(vocab_size - len(token_bytes), 0)) as phase:
+        first_vocab_size = len(token_bytes)
+        last_checkpoint = last_report = time.time()
+        while len(token_bytes) < vocab_size and pairs_stat:
+            words, pairs_stat, pair_index, pair_heap, token_bytes, token_keys, merges = bpe_merge(
+                words, freqs, pairs_stat, pair_index, pair_heap, token_bytes, token_keys, merges
+            )
+            done = len(token_bytes) - first_vocab_size
+            if progress is not None and done % progress_every == 0:
+                best = peek_best_pair(pairs_stat, pair_heap)
+                now = time.time()
+                phase.report(
+                    done,
+                    vocab_size=len(token_bytes),
+                    merges_per_sec=progress_every / max(now - last_report, 1e-9),
+                    num_pairs=len(pairs_stat),
+                    best_pair_count=best[1] if best is not None else 0,
+                )
+                last_report = now
+
+            if checkpoint_path is not None and (
+                (checkpoint_every and len(merges) % checkpoint_every == 0)
+                or (checkpoint_seconds and time.time() - last_checkpoint >= checkpoint_seconds)
+            ):
+                save_bpe_checkpoint(checkpoint_path, words, freqs, token_bytes, merges, special_tokens)
+                last_checkpoint = time.time()
+
+        if checkpoint_path is not None:
+            save_bpe_checkpoint(checkpoint_path, words, freqs, token_bytes, merges, special_tokens)
+        phase.metrics["num_merges"] = len(token_bytes) - first_vocab_size
 
+    # back to the public format
+    vocab = dict(enumerate(token_bytes))
+    merges = [(token_bytes[left], token_bytes[right]) for left, right in map(unpack_pair, merges)]
+    if vocab_sizes is not None:
+        return nested_vocabs(vocab, merges, vocab_sizes)
     return vocab, merges
 
-def bpe_merge(pre_tokens, pairs_stat, vocab, merges):
-    
+def nested_vocabs(vocab, merges, vocab_sizes):
+    """
+    Cut the `vocab`/`merges` of a training run to each of the smaller `vocab_sizes`.
+    Merged tokens are numbered in merge order, so the first `n` ids (and the merges that created them) make the `n`-token vocab.
+    """
+    num_base = len(vocab) - len(merges)  # 256 bytes + special tokens
+    result = {}
+    for size in vocab_sizes:
+        result[size] = (
+            {token_id: token for token_id, token in vocab.items() if token_id < size},
+            merges[: max(size - num_base, 0)],
+        )
+    return result
+
+def save_bpe_checkpoint(path, words, freqs, token_bytes, merges, special_tokens):
+    """
+    Snapshot the merge state: the (partially merged) pre-tokens with their counts, the vocab and the merges.
+    The words are stored as one flat id array plus offsets. The pair stats, index and heap are not stored,
+    they are rebuilt from the words on resume (the same way as after pre-tokenization).
+
+    The file is written to a temporary path first, so a job killed while saving keeps the previous snapshot.
+    """
+    flat, offsets = words.compact()
+
+    state = {
+        "version": 1,
+        "special_tokens": list(special_tokens),
+        "tokens": flat,
+        "offsets": offsets,
+        "freqs": array("Q", freqs),
+        "token_bytes": token_bytes,
+        "merges": array("Q", merges),
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_bpe_checkpoint(path, special_tokens, typecode="H"):
+    """
+    Load a snapshot written by `save_bpe_checkpoint`, returns `words, freqs, token_bytes, merges`.
+    """
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    if state["special_tokens"] != list(special_tokens):
+        raise ValueError(f"checkpoint {path} was trained with special tokens {state['special_tokens']}")
+
+    flat, offsets = state["tokens"], state["offsets"]
+    if flat.typecode != typecode:
+        flat = array(typecode, flat)
+    words = Words(flat, offsets)
+
+    return words, list(state["freqs"]), list(state["token_bytes"]), list(state["merges"])
+
+TOKENIZER_FILE_MAGIC = b"BPETOKv2"
+# magic, byte order mark, number of tokens, merges and special tokens, size of the token bytes blob
+TOKENIZER_FILE_HEADER = struct.Struct("=8sIIIIQ")
+BYTE_ORDER_MARK = 0x01020304
+
+def save_tokenizer_file(path, vocab, merges, special_tokens=()):
+    """
+    Save a trained tokenizer as one binary file, laid out as (native byte order):
+
+        header                      TOKENIZER_FILE_HEADER
+        offsets     uint64[n + 1]   token i is blob[offsets[i]:offsets[i + 1]]
+        ids         uint32[n]       id of token i, increasing
+        merges      uint32[2 * m]   merges as (left id, right id) pairs, in merge order
+        merged      uint32[m]       id of the token made by each merge
+        specials    uint32[s]       ids of the special tokens
+        blob                        the bytes of all the tokens, one after the other
+
+    The merges and the special tokens refer to the vocab by id, so every token's bytes are stored once, and a
+    tokenizer can encode straight from the id sections (see `map_tokenizer_file` and `Tokenizer.from_file`).
+    Loading the file doesn't unpickle anything - a file from elsewhere can't run code.
+    """
+    inv_vocab = {token: token_id for token_id, token in vocab.items()}
+    try:
+        merge_ids = array("I", [inv_vocab[token] for merge in merges for token in merge])
+        merged_ids = array("I", [inv_vocab[left + right] for left, right in merges])
+    except KeyError as e:
+        raise ValueError(f"merged token {e.args[0]!r} is not in the vocab") from None
+    try:
+        special_ids = array("I", [inv_vocab[t.encode("utf-8")] for t in special_tokens])
+    except KeyError as e:
+        raise ValueError(f"special token {e.args[0]!r} is not in the vocab") from None
+
+    ids = array("I", sorted(vocab))
+    offsets = array("Q", [0])
+    for token_id in ids:
+        offsets.append(offsets[-1] + len(vocab[token_id]))
+    header = TOKENIZER_FILE_HEADER.pack(TOKENIZER_FILE_MAGIC, BYTE_ORDER_MARK, len(ids), len(merges),
+                                        len(special_ids), offsets[-1])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        for section in (offsets, ids, merge_ids, merged_ids, special_ids):
+            section.tofile(f)
+        for token_id in ids:
+            f.write(vocab[token_id])
+    os.replace(tmp_path, path)
+
+def map_tokenizer_file(path):
+    """
+    Map a file written by `save_tokenizer_file`, returns its sections as arrays backed by the mapped file, nothing
+    is copied: `ids, offsets, blob, merge_ids, merged_ids, special_ids` (`merge_ids` is (m, 2), `blob` uint8).
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if len(data) < TOKENIZER_FILE_HEADER.size:
+        raise ValueError(f"{path} is not a tokenizer file")
+    magic, byte_order, num_tokens, num_merges, num_special, blob_size = TOKENIZER_FILE_HEADER.unpack(
+        data[:TOKENIZER_FILE_HEADER.size].tobytes())
+    if magic != TOKENIZER_FILE_MAGIC:
+        raise ValueError(f"{path} is not a tokenizer file (or was written by another version, save it again)")
+    if byte_order != BYTE_ORDER_MARK:
+        raise ValueError(f"{path} was written on a machine with a different byte order")
+    if len(data) != TOKENIZER_FILE_HEADER.size + 8 * (num_tokens + 1) + 4 * (num_tokens + 3 * num_merges + num_special) + blob_size:
+        raise ValueError(f"{path} is truncated or corrupted")
+
+    pos = TOKENIZER_FILE_HEADER.size
+    sections = []
+    for count, dtype in ((num_tokens + 1, np.uint64), (num_tokens, np.uint32), (2 * num_merges, np.uint32),
+                         (num_merges, np.uint32), (num_special, np.uint32)):
+        size = count * np.dtype(dtype).itemsize
+        sections.append(data[pos:pos + size].view(dtype))
+        pos += size
+    offsets, ids, merge_ids, merged_ids, special_ids = sections
+    return ids, offsets, data[pos:], merge_ids.reshape(-1, 2), merged_ids, special_ids
+
+def load_tokenizer_file(path):
+    """
+    Load a file written by `save_tokenizer_file`, returns `vocab, merges, special_tokens`.
+    """
+    ids, offsets, blob, merge_ids, _, special_ids = map_tokenizer_file(path)
+    blob = blob.tobytes()
+    offsets = offsets.tolist()
+    vocab = dict(zip(ids.tolist(), [blob[start:end] for start, end in zip(offsets, offsets[1:])]))
+    merges = [(vocab[left], vocab[right]) for left, right in merge_ids.tolist()]
+    special_tokens = [vocab[token_id].decode("utf-8") for token_id in special_ids.tolist()]
+    return vocab, merges, special_tokens
+
+def file_content_hash(input_path, cache_dir):
+    """
+    sha256 of the file content. Hashes are remembered in `cache_dir` by (path, size, mtime),
+    so an unchanged file is only read once.
+    """
+    stat = os.stat(input_path)
+    index_path = os.path.join(cache_dir, "content_hashes.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    entry = index.get(os.path.abspath(input_path))
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    with open(input_path, "rb") as f:
+        content_hash = hashlib.file_digest(f, "sha256").hexdigest()
+    index[os.path.abspath(input_path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": content_hash}
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    return content_hash
+
+def pre_token_cache_key(input_path, special_tokens, cache_dir):
+    """
+    Cache key of the pre-token counts: everything the counts depend on - the corpus content, `PAT` and the special tokens.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = json.dumps([file_content_hash(input_path, cache_dir), PAT, list(special_tokens)])
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+def load_cached_pre_tokens(cache_dir, cache_key):
+    """
+    Return the cached pre-token counts, or None on a cache miss.
+    """
+    path = os.path.join(cache_dir, f"pre_tokens-{cache_key}.pkl")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        pre_tokens = pickle.load(f)
+    os.utime(path)  # mark as recently used for eviction
+
+    return pre_tokens
+
+def save_cached_pre_tokens(cache_dir, cache_key, pre_tokens, cache_max_bytes):
+    """
+    Store the pre-token counts, then evict the least recently used entries while the cache is over `cache_max_bytes`.
+    """
+    path = os.path.join(cache_dir, f"pre_tokens-{cache_key}.pkl")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(pre_tokens, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith("pre_tokens-") and name.endswith(".pkl"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= cache_max_bytes:
+            break
+        if name == os.path.basename(path):
+            continue
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+# pairs of token ids are packed into a single int: (left << PAIR_SHIFT) | right
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+
+def pack_pair(left, right):
+    return (left << PAIR_SHIFT) | right
+
+def unpack_pair(pair):
+    return pair >> PAIR_SHIFT, pair & PAIR_MASK
+
+def reverse_key(token):
+    """
+    Sort key of a token's bytes in reverse lexicographic order (`heapq` is a min-heap, and ties
+    are broken by the lexicographically greatest pair) - a longer token with the same prefix sorts first.
+    """
+    return tuple(255 - b for b in token) + (256,)
+
+def heap_entry(count, pair, token_keys):
+    # highest count first, then the lexicographically greatest pair (compared by bytes, not ids)
+    return (-count, token_keys[pair >> PAIR_SHIFT], token_keys[pair & PAIR_MASK], pair)
+
+def peek_best_pair(pairs_stat, pair_heap):
+    """
+    Return the `(pair, count)` that will be merged next (None when no pairs are left), dropping stale entries on the way.
+    """
+    while pair_heap:
+        count, _, _, pair = pair_heap[0]
+        if pairs_stat.get(pair) == -count:
+            return pair, -count
+        heapq.heappop(pair_heap)
+    return None
+
+def pop_best_pair(pairs_stat, pair_heap):
+    """
+    Pop the most frequent pair from `pair_heap`.
+    Entries are invalidated lazily - an entry whose count no longer matches `pairs_stat` is stale and dropped.
+    """
+    while pair_heap:
+        count, _, _, pair = heapq.heappop(pair_heap)
+        if pairs_stat.get(pair) == -count:
+            return pair
+    raise ValueError("no pairs left to merge")
+
+def word_pairs(word):
+    # packed pairs of adjacent token ids in `word`
+    return [(left << PAIR_SHIFT) | right for left, right in zip(word[:-1], word[1:])]
+
+class Words:
+    """
+    The pre-tokens being merged, as token ids in one flat array: word i is `tokens[offsets[i]:offsets[i] + lengths[i]]`.
+    No object per word - a merge only shortens a word, so it is rewritten in place and the end of its slot
+    (up to `offsets[i + 1]`) is left unused. `words[i]` returns word i as a list, `words[i] = ids` rewrites it.
+    """
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.lengths = array("I", map(operator.sub, offsets[1:], offsets[:-1]))
+
+    @classmethod
+    def from_pre_tokens(cls, pre_tokens, typecode):
+        # every byte of a pre-token is the id of its byte token
+        tokens = array(typecode)
+        tokens.extend(b"".join(pre_tokens))
+        offsets = array("Q", [0])
+        offsets.extend(itertools.accumulate(map(len, pre_tokens)))
+        return cls(tokens, offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        start = self.offsets[i]
+        return self.tokens[start:start + self.lengths[i]].tolist()
+
+    def __setitem__(self, i, ids):
+        if len(ids) > self.offsets[i + 1] - self.offsets[i]:
+            raise ValueError("a word can't grow")
+        start = self.offsets[i]
+        self.tokens[start:start + len(ids)] = array(self.tokens.typecode, ids)
+        self.lengths[i] = len(ids)
+
+    def compact(self):
+        # the words without the unused ends of their slots, as `tokens, offsets`
+        tokens = array(self.tokens.typecode)
+        offsets = array("Q", [0])
+        for start, length in zip(self.offsets, self.lengths):
+            tokens.extend(self.tokens[start:start + length])
+            offsets.append(len(tokens))
+        return tokens, offsets
+
+def count_pairs(words, freqs):
+    """
+    Count the token-pairs over all `words` (weighted by `freqs`), and build the inverted index
+    from each pair to the indices of the words containing it (an `array("I")` per pair).
+
+    The index is only appended to: a word is not removed from the index of a pair it loses, it is skipped when
+    that pair is merged. A word gains a pair only in the merge that creates one of its tokens, so it is never
+    listed twice for a pair.
+    """
+    pairs_stat = dict()
+    pair_index = defaultdict(lambda: array("I"))
+    for word_idx in range(len(words)):
+        freq = freqs[word_idx]
+        pairs = word_pairs(words[word_idx])
+        for pair in pairs:
+            pairs_stat[pair] = pairs_stat.get(pair, 0) + freq
+        for pair in set(pairs):
+            pair_index[pair].append(word_idx)
+
+    return pairs_stat, pair_index
+
+def merge_word(word, pair, merged):
+    """
+    Replace every (left to right, non-overlapping) occurence of the token-id `pair` in `word` with `merged`.
+    Returns the new word, and the pairs it lost and gained (packed, repeated as often as they occur):
+    only the pairs around each occurence change, the rest of the word is not counted again.
+    """
+    left, right = unpack_pair(pair)
+    new_word = []
+    removed = []
+    added = []
+    size = len(word)
+    idx = 0
+    while idx < size:
+        if word[idx] == left and idx < size - 1 and word[idx+1] == right:
+            removed.append(pair)
+            if idx > 0:
+                # the previous token may be a merge of this step already, the pair it had in the word was with `right`
+                removed.append((word[idx-1] << PAIR_SHIFT) | left)
+                added.append((new_word[-1] << PAIR_SHIFT) | merged)
+            # a next occurence counts the pair between the two
+            if idx + 2 < size and not (word[idx+2] == left and idx + 3 < size and word[idx+3] == right):
+                removed.append((right << PAIR_SHIFT) | word[idx+2])
+                added.append((merged << PAIR_SHIFT) | word[idx+2])
+            new_word.append(merged)
+            idx += 2
+        else:
+            new_word.append(word[idx])
+            idx += 1
+
+    return new_word, removed, added
+
+def encode_word(word, ranks, first_id):
+    """
+    BPE-encode `word` with ranked merges: repeatedly merge the adjacent pair of lowest rank,
+    the pair of rank `r` becoming token `first_id + r`.
+    """
+    tokens = word
+    while len(tokens) > 1:
+        best_rank = None
+        for left, right in zip(tokens[:-1], tokens[1:]):
+            rank = ranks.get((left << PAIR_SHIFT) | right)
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best_rank, best_pair = rank, (left, right)
+        if best_rank is None:
+            break
+
+        new_tokens = []
+        idx = 0
+        while idx < len(tokens):
+            if idx < len(tokens) - 1 and (tokens[idx], tokens[idx+1]) == best_pair:
+                new_tokens.append(first_id + best_rank)
+                idx += 2
+            else:
+                new_tokens.append(tokens[idx])
+                idx += 1
+        tokens = new_tokens
+
+    return tokens
+
+def apply_initial_merges(words, token_bytes, initial_merges):
+    """
+    Warm start - add the tokens created by `initial_merges` to `token_bytes` and apply the merges
+    to all the `words` in bulk (each word is encoded once, instead of replaying the merges one by one).
+    Returns the merges as packed id pairs.
+    """
+    token_ids = {token: token_id for token_id, token in enumerate(token_bytes)}
+    first_id = len(token_bytes)
+    ranks = {}
+    merges = []
+    for left, right in initial_merges:
+        if left not in token_ids or right not in token_ids:
+            raise ValueError(f"initial merge {(left, right)} uses a token that is not in the vocab")
+        if left + right in token_ids:
+            raise ValueError(f"initial merge {(left, right)} creates a token that is already in the vocab")
+        pair = pack_pair(token_ids[left], token_ids[right])
+        ranks[pair] = len(merges)
+        merges.append(pair)
+        token_ids[left + right] = len(token_bytes)
+        token_bytes.append(left + right)
+
+    for word_idx in range(len(words)):
+        words[word_idx] = encode_word(words[word_idx], ranks, first_id)
+
+    return merges
+
+def bpe_merge(words, freqs, pairs_stat, pair_index, pair_heap, token_bytes, token_keys, merges):
+    """
+    Run a single merge step.
+
+    Only the words holding the merged pair (looked up in `pair_index`) are visited, so a merge
+    costs time proportional to the number of affected words rather than the whole table.
+    The words are merged in place, and only the pairs around the merged occurences are counted again.
+    The best pair is taken from `pair_heap`, every pair whose count changed is pushed again.
+    """
+
     # high-freq pair
-    merge_cand = max(pairs_stat, key=lambda k: (pairs_stat[k], k))
+    merge_cand = pop_best_pair(pairs_stat, pair_heap)
 
     # merge update
     merges.append(merge_cand)
 
     # update vocab
-    merged_bp = merge_cand[0] + merge_cand[1]
-    token_idx = len(vocab)
-    vocab[token_idx] = merged_bp
-
-    # update pre_tokens + byte-pair stat
-    pre_tokens_new = {}
-    
-    for pre_token, freq in pre_tokens.items():
-        #key = pre_token
-        idx = 0
-        while idx < len(pre_token):
-            if pre_token[idx:idx+2] == merge_cand:
-
-                # update stat of new token pairs
-                if pre_token[:idx]:
-                    key_l = (pre_token[idx-1], merged_bp)
-                    pairs_stat[key_l] = pairs_stat.get(key_l, 0) + freq
-                    pairs_stat[(pre_token[idx-1], pre_token[idx])] -= freq
-                
-                if pre_token[idx+2:]:
-                    key_r = (merged_bp, pre_token[idx + 2])
-                    pairs_stat[key_r] = pairs_stat.get(key_r, 0) + freq
-                    pairs_stat[(pre_token[idx+1], pre_token[idx+2])] -= freq
-                
-                pairs_stat[merge_cand] -= freq
-
-                # create merged pretoken
-                lst = list(pre_token)
-                lst[idx] = merged_bp
-                lst.pop(idx+1)
-                pre_token = tuple(lst) 
+    left, right = unpack_pair(merge_cand)
+    token_idx = len(token_bytes)
+    token_bytes.append(token_bytes[left] + token_bytes[right])
+    token_keys.append(reverse_key(token_bytes[-1]))
 
-            idx += 1
+    # update affected words + pair stat + pair index
+    changed = set()
+    for word_idx in pair_index.pop(merge_cand, ()):
+        freq = freqs[word_idx]
+        new_word, removed, added = merge_word(words[word_idx], merge_cand, token_idx)
+        if not removed:
+            # the word lost the pair in an earlier merge, see `count_pairs`
+            continue
+
+        changed.update(removed)
+        changed.update(added)
+        for pair in removed:
+            pairs_stat[pair] -= freq
+            if pairs_stat[pair] == 0:
+                del pairs_stat[pair]
+        for pair in added:
+            pairs_stat[pair] = pairs_stat.get(pair, 0) + freq
+        for pair in set(added):
+            pair_index[pair].append(word_idx)
+
+        words[word_idx] = new_word
 
-            
+    for pair in changed:
+        if pair in pairs_stat:
+            heapq.heappush(pair_heap, heap_entry(pairs_stat[pair], pair, token_keys))
 
-        pre_tokens_new[pre_token] = freq
-    pre_tokens = pre_tokens_new    
+    # drop the stale entries once they dominate the heap
+    if len(pair_heap) > 2 * len(pairs_stat) + 1024:
+        pair_heap = [heap_entry(count, pair, token_keys) for pair, count in pairs_stat.items()]
+        heapq.heapify(pair_heap)
 
-    return pre_tokens, pairs_stat, vocab, merges
+    return words, pairs_stat, pair_index, pair_heap, token_bytes, token_keys, merges
 
 
 
 if __name__ == "__main__":
     import time
 
-    from cs336_basics.train_bpe import train_bpe
+    from cs336_basics.progress import TqdmProgress
+    from cs336_basics.train_bpe import save_tokenizer_file, train_bpe
 
     #input_path = "data/TinyStoriesV2-GPT4-train.txt"
     input_path = "data/owt_train.txt"
@@ -139,7 +749,9 @@ if __name__ == "__main__":
             input_path=input_path,
             vocab_size=32000,
             special_tokens=["<|endoftext|>"],
+            progress=TqdmProgress(),
         )
     end_time = time.time()
     elapsed_ms = (end_time - start_time) * 1000
-    print(f"Elapsed time: {elapsed_ms:.2f} ms")
\ No newline at end of file
+    print(f"Elapsed time: {elapsed_ms:.2f} ms")
+    save_tokenizer_file("data/out/owt_32000.tok", vocab, merges, special_tokens=["<|endoftext|>"])
\ No newline at end of file
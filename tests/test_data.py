@@ -1,10 +1,17 @@
+import json
 import math
+import os
 from collections import Counter
 
 import numpy as np
 import pytest
+import torch
 
+from cs336_basics.data import BatchSampler, load_doc_offsets, load_token_dataset, tokenize_to_bin, tokenize_to_shards
+from cs336_basics.tokenizer import Tokenizer
 from .adapters import run_get_batch
+from .common import FIXTURES_PATH
+from .test_tokenizer import MERGES_PATH, VOCAB_PATH, get_tokenizer_from_vocab_merges_path
 
 
 def test_get_batch():
@@ -70,3 +77,130 @@ def test_get_batch():
             device="cuda:99",
         )
         assert "CUDA error" in str(excinfo.value) or "Torch not compiled with CUDA enabled" in str(excinfo.value)
+
+
+def test_get_batch_from_shards(tmp_path):
+    # two shards of a manifest, a window never spans both
+    shards = [np.arange(0, 50, dtype=np.uint16), np.arange(1000, 1030, dtype=np.uint16)]
+    manifest = {"num_tokens": 80, "dtype": "uint16", "shards": []}
+    for i, shard in enumerate(shards):
+        shard.tofile(tmp_path / f"shard_{i}.bin")
+        manifest["shards"].append({"path": f"shard_{i}.bin", "num_tokens": len(shard)})
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+
+    dataset = load_token_dataset(str(tmp_path / "manifest.json"))
+    context_length = 7
+    starting_indices = Counter()
+    for _ in range(200):
+        x, y = run_get_batch(dataset=dataset, batch_size=32, context_length=context_length, device="cpu")
+        assert x.dtype == torch.int64
+        np.testing.assert_allclose((x + 1).numpy(), y.numpy())
+        starting_indices.update(x[:, 0].tolist())
+    assert set(starting_indices) == set(range(0, 50 - context_length)) | set(range(1000, 1030 - context_length))
+
+
+def test_batch_sampler_memmap(tmp_path):
+    path = tmp_path / "tokens.bin"
+    np.arange(0, 5000, dtype=np.uint16).tofile(path)
+    dataset = np.memmap(path, dtype=np.uint16, mode="r")
+
+    sampler = BatchSampler(dataset, batch_size=16, context_length=32, device="cpu", seed=0)
+    x, y = sampler.sample()
+    assert x.shape == y.shape == (16, 32) and x.dtype == y.dtype == torch.int64
+    assert x.is_contiguous() and y.is_contiguous()
+    np.testing.assert_array_equal(x.numpy(), x[:, :1].numpy() + np.arange(32))
+    np.testing.assert_array_equal((x + 1).numpy(), y.numpy())
+
+    # the output buffers are reused by the next batch
+    first = x.clone()
+    x2, _ = sampler.sample()
+    assert x2.data_ptr() == x.data_ptr() and not torch.equal(x2, first)
+    assert BatchSampler(dataset, 16, 32, seed=0).sample()[0].equal(first)
+
+    # devices other than cuda are copied to synchronously
+    x, y = BatchSampler(dataset, batch_size=4, context_length=8, device="meta").sample()
+    assert x.device.type == y.device.type == "meta" and x.shape == (4, 8)
+
+    with pytest.raises(ValueError):
+        BatchSampler(dataset[:32], batch_size=4, context_length=32)
+
+
+def test_tokenize_to_bin_matches_encode(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    with open(input_path) as f:
+        ids = tokenizer.encode(f.read())
+    eot_id = tokenizer.encode("<|endoftext|>")[0]
+
+    # small shards and blocks, so that there are several shards written in several blocks each
+    for num_workers in (1, 2):
+        output_path = tmp_path / f"tokens_{num_workers}.bin"
+        num_tokens = tokenize_to_bin(input_path, output_path, tokenizer, num_workers=num_workers,
+                                     shard_bytes=1024, block_size=64)
+        assert num_tokens == len(ids)
+        assert np.fromfile(output_path, dtype=np.uint16).tolist() == ids
+        # documents start at 0 and after every <|endoftext|>
+        (doc_offsets,) = load_doc_offsets(str(output_path))
+        assert doc_offsets.tolist() == [0] + [i + 1 for i, _id in enumerate(ids[:-1]) if _id == eot_id]
+    assert sorted(os.listdir(tmp_path)) == sorted(f"tokens_{n}.{ext}" for n in (1, 2) for ext in ("bin", "docs"))
+
+
+def test_tokenize_to_shards_resumes(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    with open(input_path) as f:
+        ids = tokenizer.encode(f.read())
+    eot_id = tokenizer.encode("<|endoftext|>")[0]
+
+    records = []
+    manifest = tokenize_to_shards(input_path, tmp_path, tokenizer, num_workers=2, shard_bytes=1024,
+                                  progress=records.append)
+    shards = manifest["shards"]
+    assert len(shards) > 2 and manifest["num_tokens"] == len(ids)
+    assert shards[0]["start"] == 0 and shards[-1]["end"] == os.path.getsize(input_path)
+    assert all(a["end"] == b["start"] for a, b in zip(shards, shards[1:]))
+    dataset = load_token_dataset(tmp_path / "manifest.json")
+    assert np.concatenate(dataset).tolist() == ids
+    # every shard starts with a document, and the documents end with <|endoftext|>
+    for tokens, doc_offsets in zip(dataset, load_doc_offsets(str(tmp_path / "manifest.json"))):
+        assert doc_offsets[0] == 0
+        assert tokens[doc_offsets[1:] - 1].tolist() == [eot_id] * (len(doc_offsets) - 1)
+    assert manifest["num_docs"] == sum(shard["num_docs"] for shard in shards) == ids.count(eot_id) + (ids[-1] != eot_id)
+
+    # a job killed half way: one shard is missing, the next run only redoes that one
+    os.remove(tmp_path / shards[1]["docs"])
+    records.clear()
+    resumed = tokenize_to_shards(input_path, tmp_path, tokenizer, num_workers=2, shard_bytes=1024,
+                                 progress=records.append)
+    assert records[-1]["num_skipped"] == len(shards) - 1
+    assert resumed == manifest
+
+    # a shard with the right size but other content is redone as well
+    shard_path = tmp_path / shards[0]["path"]
+    content = shard_path.read_bytes()
+    shard_path.write_bytes(bytes(len(content)))
+    records.clear()
+    resumed = tokenize_to_shards(input_path, tmp_path, tokenizer, num_workers=2, shard_bytes=1024,
+                                 progress=records.append)
+    assert records[-1]["num_skipped"] == len(shards) - 1
+    assert resumed == manifest and shard_path.read_bytes() == content
+
+    # the shards are not reused with a different tokenizer
+    other_tokenizer = Tokenizer(tokenizer.vocav, tokenizer.merges[:100], ["<|endoftext|>"])
+    with pytest.raises(ValueError):
+        tokenize_to_shards(input_path, tmp_path, other_tokenizer, shard_bytes=1024)
+
+    # nor for a source edited since, even to the same size
+    edited_path = tmp_path / "corpus.txt"
+    edited_path.write_bytes(input_path.read_bytes())
+    tokenize_to_shards(edited_path, tmp_path / "edited", tokenizer, shard_bytes=1024)
+    edited_path.write_bytes(input_path.read_bytes().replace(b"Once", b"ONCE"))
+    stat = os.stat(edited_path)
+    os.utime(edited_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))  # on a coarse clock the mtime may not move
+    with pytest.raises(ValueError):
+        tokenize_to_shards(edited_path, tmp_path / "edited", tokenizer, shard_bytes=1024)
@@ -2,13 +2,19 @@ from __future__ import annotations
 
 import json
 import os
+import pickle
+import random
 import resource
 import sys
 
+import numpy as np
 import psutil
 import pytest
 import tiktoken
 
+from cs336_basics.pretokenize import SpecialTokenMatcher, iter_pre_tokens, stream_pre_tokens
+from cs336_basics.tokenizer import Tokenizer
+from cs336_basics.train_bpe import load_tokenizer_file, save_tokenizer_file
 from .adapters import get_tokenizer
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
@@ -462,3 +468,192 @@ def _encode(tokenizer, text):
     for just this function. We set the memory limit to 1MB.
     """
     return tokenizer.encode(text)
+
+
+def test_encode_pre_token_cache_is_bounded():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    small_cache_tokenizer = Tokenizer(tokenizer.vocav, tokenizer.merges, cache_size=16)
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+
+    ids = small_cache_tokenizer.encode(corpus_contents)
+    assert ids == tokenizer.encode(corpus_contents)
+    info = small_cache_tokenizer.cache_info()
+    assert info["currsize"] == 16
+    assert info["hits"] > 0 and info["misses"] > 0
+
+    # repeated pre-tokens are served from the cache
+    small_cache_tokenizer.encode(" the the the")
+    assert small_cache_tokenizer.cache_info()["hits"] >= info["hits"] + 2
+
+
+def test_encode_batch_matches_encode():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        documents = f.read().split("<|endoftext|>")
+    documents += ["", "<|endoftext|>", "Héllò hôw are ü? 🙃"]
+    try:
+        assert tokenizer.encode_batch(documents, num_workers=2) == [tokenizer.encode(doc) for doc in documents]
+        # the pool is kept for the next batch
+        assert tokenizer.encode_batch(documents[::-1], num_workers=2) == [tokenizer.encode(doc) for doc in documents[::-1]]
+    finally:
+        tokenizer.close()
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="rlimit support for non-linux systems is spotty.",
+)
+def test_encode_iterable_single_line_memory_usage(tmp_path):
+    """
+    A file without any newline is one giant "line", encode_iterable should still read it in bounded buffers.
+    """
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        sample = f.read().replace("\n", " ")
+    input_path = tmp_path / "single_line.txt"
+    with open(input_path, "w") as f:
+        for _ in range(2000):
+            f.write(sample)
+
+    with open(input_path) as f:
+        num_ids = _count_encode_iterable(tokenizer, f)
+    assert num_ids == 2000 * len(tokenizer.encode(sample))
+
+
+@memory_limit(int(4e6))
+def _count_encode_iterable(tokenizer, iterable):
+    return sum(1 for _ in tokenizer.encode_iterable(iterable))
+
+
+def test_encode_to_array_matches_encode():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read()
+    ids = tokenizer.encode(corpus_contents)
+
+    arr = tokenizer.encode_to_array(corpus_contents)
+    assert arr.dtype == np.uint16
+    assert arr.tolist() == ids
+
+    # streaming, into a growable buffer and into a preallocated one
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        arr = tokenizer.encode_iterable_to_array(f, block_size=100)
+    assert arr.tolist() == ids
+    out = np.zeros(len(ids) + 10, dtype=np.uint32)
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        arr = tokenizer.encode_iterable_to_array(f, out=out, block_size=100)
+    assert arr.dtype == np.uint32 and arr.tolist() == ids
+    with pytest.raises(ValueError), open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        tokenizer.encode_iterable_to_array(f, out=out[:10])
+
+
+def test_decode_iterable_streams_complete_characters():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    test_string = "Héllò hôw <|endoftext|><|endoftext|> are ü? 🙃<|endoftext|>"
+    ids = tokenizer.encode(test_string)
+    assert "".join(tokenizer.decode_iterable(ids)) == test_string
+
+    # the emoji spans several tokens: nothing is emitted until its last byte arrives
+    emoji_ids = tokenizer.encode("🙃")
+    assert len(emoji_ids) > 1
+    decoder = tokenizer.incremental_decoder()
+    assert [decoder.decode([_id]) for _id in emoji_ids] == [""] * (len(emoji_ids) - 1) + ["🙃"]
+    assert decoder.flush() == ""
+
+    # unknown ids decode to the replacement character
+    assert tokenizer.decode([len(tokenizer.vocav) + 10]) == "�"
+
+
+def test_many_overlapping_special_tokens():
+    # control tokens sharing prefixes with each other: the longest one starting first wins
+    special_tokens = ["<|endoftext|>", "<|end|>", "<|end|><|end|>", "<|im_start|>", "<|im_end|>"] + [
+        f"<|reserved_{i}|>" for i in range(50)
+    ]
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=special_tokens
+    )
+    test_string = "<|im_start|>hi<|end|><|end|><|end|>x<|reserved_1|><|reserved_12|> <|endoftext|><|end"
+    ids = tokenizer.encode(test_string)
+    tokenized_string = [tokenizer.decode([x]) for x in ids]
+    assert tokenized_string[:6] == ["<|im_start|>", "hi", "<|end|><|end|>", "<|end|>", "x", "<|reserved_1|>"]
+    assert "<|reserved_12|>" in tokenized_string and "<|endoftext|>" in tokenized_string
+    assert tokenizer.decode(ids) == test_string
+
+    # a partial special token at the end of a chunk is held back until the next one completes it
+    assert "".join(tokenizer.decode_iterable(tokenizer.encode_iterable(iter(["a<|reser", "ved_7|>b<|end|", "><|end|>"])))) \
+        == "a<|reserved_7|>b<|end|><|end|>"
+    assert tokenizer.special_matcher.partial_suffix_len("ab<|reser") == 7
+    assert tokenizer.special_matcher.partial_suffix_len("ab<|x") == 0
+
+
+def test_init_does_not_mutate_vocab():
+    vocab = {0: b"a", 1: b"b", 2: b"ab", 3: b"<|endoftext|>"}
+    tokenizer = Tokenizer(vocab, [(b"a", b"b")], special_tokens=["<|endoftext|>", "<|pad|>", "<|pad|>"])
+    assert vocab == {0: b"a", 1: b"b", 2: b"ab", 3: b"<|endoftext|>"}
+    # existing special tokens keep their id, new ones are appended once
+    assert tokenizer.vocav == {**vocab, 4: b"<|pad|>"}
+    assert tokenizer.encode("ab<|endoftext|><|pad|>") == [2, 3, 4]
+
+
+def test_tokenizer_file_roundtrip(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    path = tmp_path / "gpt2.tok"
+    save_tokenizer_file(path, tokenizer.vocav, tokenizer.merges, ["<|endoftext|>"])
+    vocab, merges, special_tokens = load_tokenizer_file(path)
+    assert vocab == tokenizer.vocav
+    assert merges == tokenizer.merges
+    assert special_tokens == ["<|endoftext|>"]
+
+    # encodes from the mapped id sections, the vocab and the merges are only built when asked for
+    loaded = Tokenizer.from_file(path)
+    test_string = "Héllò hôw <|endoftext|><|endoftext|> are ü? 🙃<|endoftext|>"
+    assert loaded.encode(test_string) == tokenizer.encode(test_string)
+    assert "vocav" not in loaded.__dict__ and "merges" not in loaded.__dict__
+    assert loaded.decode(loaded.encode(test_string)) == test_string
+    assert loaded.vocav == tokenizer.vocav and loaded.merges == tokenizer.merges
+    assert pickle.loads(pickle.dumps(loaded)).encode(test_string) == tokenizer.encode(test_string)
+    # a special token that is not in the file is added as by the constructor
+    with_pad = Tokenizer.from_file(path, special_tokens=["<|endoftext|>", "<|pad|>"])
+    assert with_pad.encode("a<|pad|>") == tokenizer.encode("a") + [len(tokenizer.vocav)]
+
+    with pytest.raises(ValueError):
+        save_tokenizer_file(tmp_path / "bad.tok", {0: b"a"}, [(b"a", b"b")])
+    (tmp_path / "bad.tok").write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        load_tokenizer_file(tmp_path / "bad.tok")
+
+
+def test_stream_pre_tokens_random_splits_match_whole_text():
+    # a buffer ending in "'r", "'l" or "'v" must not split the contraction: "'" "r" -> "'re"
+    matcher = SpecialTokenMatcher(["<|endoftext|>"])
+    assert list(stream_pre_tokens(iter("you're"), matcher)) == [b"you", b"'re"]
+
+    rng = random.Random(0)
+    pieces = ["you", "'", "re", "ll", "ve", "s", "d", " ", "  ", "\n", "42", "!?", "é", "<|endoftext|>", "<|end"]
+    for _ in range(500):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+        cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 8))))
+        chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+        keep_special = rng.random() < 0.5
+        pre_tokens = list(stream_pre_tokens(iter(chunks), matcher, keep_special, buffer_size=rng.randint(1, 6)))
+        assert pre_tokens == list(iter_pre_tokens(text, matcher, keep_special)), chunks
+
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    assert list(tokenizer.encode_iterable(iter("you're<|endoftext|>"), buffer_size=1)) \
+        == tokenizer.encode("you're<|endoftext|>")
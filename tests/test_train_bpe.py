@@ -1,7 +1,19 @@
 import json
+import random
+import sys
+from collections import Counter
 import time
+
+import pytest
+
+import cs336_basics.train_bpe as train_bpe_module
+from cs336_basics import chunking
+from cs336_basics.chunking import find_chunk_boundaries
+from cs336_basics.progress import Phase, peak_rss
+from cs336_basics.train_bpe import count_pre_tokens
 from .adapters import run_train_bpe
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
+from .test_tokenizer import memory_limit
 
 
 def test_train_bpe_speed():
@@ -85,3 +97,238 @@ def test_train_bpe_special_tokens(snapshot):
             "merges": merges,
         },
     )
+
+
+def test_train_bpe_parallel_matches_serial():
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+    )
+    vocab_parallel, merges_parallel = run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        num_workers=4,
+    )
+    assert merges_parallel == merges
+    assert vocab_parallel == vocab
+
+
+def test_find_chunk_boundaries(tmp_path, monkeypatch):
+    # a long document in the middle doesn't merge the chunks after it
+    path = tmp_path / "corpus.txt"
+    path.write_bytes(b"short<|endoftext|>" * 100 + b"x" * 5000 + b"<|endoftext|>" + b"short<|endoftext|>" * 400)
+    data = path.read_bytes()
+    boundaries = find_chunk_boundaries(path, 16, [b"<|endoftext|>"])
+    assert len(boundaries) == 17 and boundaries[0] == 0 and boundaries[-1] == len(data)
+    assert all(data.startswith(b"<|endoftext|>", b) for b in boundaries[1:-1])
+    sizes = [end - start for start, end in zip(boundaries, boundaries[1:])]
+    assert sorted(sizes)[-2] < 2 * len(data) / 16
+
+    # several split tokens, never split inside one of them; with `split_after` after the token
+    path.write_bytes(b"a<|endoftext|>b<|pad|><|pad|>c<|endoftext|>d" * 20)
+    data = path.read_bytes()
+    for split_after in (False, True):
+        boundaries = find_chunk_boundaries(path, 30, [b"<|endoftext|>", b"<|pad|><|pad|>", b"<|pad|>"], split_after)
+        assert len(boundaries) == 31
+        for b in boundaries[1:-1]:
+            if split_after:
+                assert data[b - 1:b] == b">" and data[b:b + 7] != b"<|pad|>"
+            else:
+                assert data[b:b + 2] == b"<|" and data[b - 7:b] != b"<|pad|>"
+
+    # the search windows only bound the work, not the result: an unused split token and tiny windows
+    for split_after in (False, True):
+        expected = find_chunk_boundaries(path, 30, [b"<|endoftext|>", b"<|pad|>"], split_after)
+        with monkeypatch.context() as m:
+            m.setattr(chunking, "SEARCH_WINDOW", 4)
+            assert find_chunk_boundaries(path, 30, [b"<|endoftext|>", b"<|unused|>", b"<|pad|>"], split_after) \
+                == expected
+
+    assert find_chunk_boundaries(path, 4, []) == [0, len(data)]
+    (tmp_path / "empty.txt").write_bytes(b"")
+    assert find_chunk_boundaries(tmp_path / "empty.txt", 4, [b"<|endoftext|>"]) == [0]
+
+
+def test_count_pre_tokens_chunk_sizes_match(tmp_path):
+    text = "you're we'll they've<|endoftext|>it's I'd <|endoftext|> \n\nwe're  " * 20
+    input_path = tmp_path / "corpus.txt"
+    input_path.write_text(text)
+    expected = count_pre_tokens(input_path, ["<|endoftext|>"])
+    assert expected[b"'re"] == 40
+    for chunk_size in (1, 2, 3, 4, 5, 7, 64):
+        assert count_pre_tokens(input_path, ["<|endoftext|>"], chunk_size=chunk_size) == expected, chunk_size
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="rlimit support for non-linux systems is spotty.",
+)
+def test_count_pre_tokens_streaming_memory_usage(tmp_path):
+    """
+    Streaming pre-token counting should need memory for one chunk and the (small) table of
+    unique pre-tokens, not for the whole ~10MB file.
+    """
+    sample = (FIXTURES_PATH / "tinystories_sample.txt").read_text()
+    input_path = tmp_path / "corpus.txt"
+    with open(input_path, "w") as f:
+        for _ in range(2500):
+            f.write(sample)
+
+    reference = count_pre_tokens(FIXTURES_PATH / "tinystories_sample.txt", ["<|endoftext|>"])
+    counts = _count_pre_tokens_streaming(input_path, ["<|endoftext|>"])
+    assert counts == {pre_token: 2500 * freq for pre_token, freq in reference.items()}
+
+
+@memory_limit(int(5e6))
+def _count_pre_tokens_streaming(input_path, special_tokens):
+    return count_pre_tokens(input_path, special_tokens, chunk_size=256 * 1024)
+
+
+def test_train_bpe_resume_matches_uninterrupted(tmp_path):
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint_path = tmp_path / "bpe.ckpt"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    # stop half way (the checkpoint is also written when training ends), then continue
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=350,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=10,
+    )
+    vocab_resumed, merges_resumed = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        resume_from=checkpoint_path,
+    )
+    assert merges_resumed == merges
+    assert vocab_resumed == vocab
+
+
+def test_train_bpe_pre_token_cache(tmp_path, monkeypatch):
+    input_path = FIXTURES_PATH / "corpus.en"
+    cache_dir = tmp_path / "cache"
+    _, merges_small = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        cache_dir=cache_dir,
+    )
+    assert len(list(cache_dir.glob("pre_tokens-*.pkl"))) == 1
+
+    # a second run at another vocab size must not pre-tokenize again
+    def fail(*args, **kwargs):
+        raise AssertionError("pre-tokenization should come from the cache")
+
+    monkeypatch.setattr(train_bpe_module, "count_pre_tokens", fail)
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        cache_dir=cache_dir,
+    )
+    assert merges[: len(merges_small)] == merges_small
+    assert len(vocab) == 500
+
+
+def test_train_bpe_nested_vocab_sizes():
+    input_path = FIXTURES_PATH / "corpus.en"
+    tokenizers = run_train_bpe(
+        input_path=input_path,
+        vocab_size=[300, 500],
+        special_tokens=["<|endoftext|>"],
+    )
+    for vocab_size in [300, 500]:
+        vocab, merges = run_train_bpe(
+            input_path=input_path,
+            vocab_size=vocab_size,
+            special_tokens=["<|endoftext|>"],
+        )
+        assert tokenizers[vocab_size] == (vocab, merges)
+
+
+def test_train_bpe_initial_merges():
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    # warm-starting from the first merges of a run continues it exactly
+    vocab_warm, merges_warm = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        initial_merges=merges[:100],
+    )
+    assert merges_warm == merges
+    assert vocab_warm == vocab
+
+
+def test_train_bpe_progress_records():
+    records = []
+    _, merges = run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        progress=records.append,
+        progress_every=50,
+    )
+    phases = [record["phase"] for record in records if record["event"] == "phase_end"]
+    assert phases == ["pre_tokenization", "pair_counting", "merging"]
+    for record in records:
+        if record["event"] == "phase_end":
+            assert record["seconds"] >= 0 and (record.get("peak_rss") or record["max_rss"]) > 0
+    merge_records = [record for record in records if record["event"] == "progress"]
+    assert [record["done"] for record in merge_records] == list(range(50, len(merges) + 1, 50))
+    assert all(record["best_pair_count"] > 0 and record["num_pairs"] > 0 for record in merge_records)
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="the peak memory can only be reset on linux")
+def test_phase_peak_rss_is_per_phase():
+    records = []
+    with Phase(records.append, "outer"):
+        with Phase(records.append, "big"):
+            block = bytearray(256 * 2**20)
+            block[::4096] = b"x" * len(block[::4096])  # touch every page
+            del block
+        with Phase(records.append, "small"):
+            pass
+    peaks = {record["phase"]: record["peak_rss"] for record in records if record["event"] == "phase_end"}
+    assert peaks["small"] < peaks["big"] - 128 * 2**20
+    assert peaks["outer"] >= peaks["big"]
+
+    # without a progress callback the peak of the process is left alone
+    block = bytearray(256 * 2**20)
+    block[::4096] = b"x" * len(block[::4096])
+    del block
+    before = peak_rss()
+    with Phase(None, "quiet"):
+        pass
+    assert peak_rss() >= before
+
+
+def test_train_bpe_missing_input_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        run_train_bpe(input_path=tmp_path / "missing.txt", vocab_size=500, special_tokens=["<|endoftext|>"])
+
+
+def test_merge_word_pair_changes_match_recount():
+    # the pairs lost and gained around the merged occurences are the whole difference of the word's pair counts
+    rng = random.Random(0)
+    for _ in range(2000):
+        word = [rng.choice([1, 2, 3]) for _ in range(rng.randint(1, 12))]
+        pair = train_bpe_module.pack_pair(rng.choice([1, 2, 3]), rng.choice([1, 2, 3]))
+        new_word, removed, added = train_bpe_module.merge_word(word, pair, 9)
+        old_counts = Counter(train_bpe_module.word_pairs(word))
+        new_counts = Counter(train_bpe_module.word_pairs(new_word))
+        assert Counter(removed) == old_counts - new_counts
+        assert Counter(added) == new_counts - old_counts